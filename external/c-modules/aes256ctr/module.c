@@ -64,16 +64,30 @@ is_unaligned(const void *p)
     return !!(((uint32_t)p) & 0x3);
 }
 
-STATIC mp_obj_t s_AES256CTR_cipher(mp_obj_t self_in, mp_obj_t buf_in)
+STATIC mp_obj_t s_AES256CTR_cipher(size_t n_args, const mp_obj_t *args)
 {
-    mp_obj_AES256CTR_t *self = MP_OBJ_TO_PTR(self_in);
+    // args: self, buf, [out]
+    // - if out is given, result written there (can be same as buf) and returned
+    mp_obj_AES256CTR_t *self = MP_OBJ_TO_PTR(args[0]);
 
     mp_buffer_info_t buf;
-    mp_get_buffer_raise(buf_in, &buf, MP_BUFFER_READ);
+    mp_get_buffer_raise(args[1], &buf, MP_BUFFER_READ);
 
     int len = buf.len, in_len = buf.len;
     const uint8_t *inp = buf.buf;
-    uint8_t *rv = m_malloc(in_len);
+    uint8_t *rv;
+
+    if(n_args == 3) {
+        mp_buffer_info_t out;
+        mp_get_buffer_raise(args[2], &out, MP_BUFFER_WRITE);
+
+        if(out.len < buf.len) {
+            mp_raise_ValueError(NULL);
+        }
+        rv = out.buf;
+    } else {
+        rv = m_malloc(in_len);
+    }
     uint8_t *outp = rv;
 
     if(self->runt_len) {
@@ -86,7 +100,8 @@ STATIC mp_obj_t s_AES256CTR_cipher(mp_obj_t self_in, mp_obj_t buf_in)
         }
     }
 
-    bool nogood = (is_unaligned(inp) || is_unaligned(outp));
+    // also take the slow path when working in-place
+    bool nogood = (is_unaligned(inp) || is_unaligned(outp) || (inp == outp));
 
     while(in_len) {
         if(in_len >= BLKSIZE) {
@@ -124,9 +139,13 @@ STATIC mp_obj_t s_AES256CTR_cipher(mp_obj_t self_in, mp_obj_t buf_in)
         }
     }
 
+    if(n_args == 3) {
+        return args[2];
+    }
+
     return mp_obj_new_bytearray_by_ref(len, rv);
 }
-STATIC MP_DEFINE_CONST_FUN_OBJ_2(s_AES256CTR_cipher_obj, s_AES256CTR_cipher);
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(s_AES256CTR_cipher_obj, 2, 3, s_AES256CTR_cipher);
 
 STATIC mp_obj_t s_AES256CTR_copy(mp_obj_t self_in) {
     mp_obj_AES256CTR_t *self = MP_OBJ_TO_PTR(self_in);
@@ -114,7 +114,13 @@ Extended Master Key:
 
 async def show_settings_space(*a):
 
-    await ux_show_story('Settings storage space in use:\n\n       %d%%' % int(settings.capacity * 100))
+    msg = 'Settings storage space in use:\n\n       %d%%' % int(settings.capacity * 100)
+
+    # multisig wallets have their own space
+    if settings.get('multisig'):
+        msg += '\n\nMultisig wallets:\n\n       %d%%' % int(settings.capacity_of('multisig') * 100)
+
+    await ux_show_story(msg)
 
 async def maybe_dev_menu(*a):
     from version import is_devmode
@@ -833,9 +839,10 @@ async def start_login_sequence():
     # **before** the USB is even enabled.
     if version.has_fatram:
         try:
-            import hsm, hsm_ux
+            from utils import hsm_policy_available
 
-            if hsm.hsm_policy_available():
+            if hsm_policy_available():
+                import hsm_ux
                 ar = await hsm_ux.start_hsm_approval(usb_mode=False, startup_mode=True)
                 if ar:
                     await ar.interact()
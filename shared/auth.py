@@ -7,7 +7,7 @@ import stash, ure, ux, chains, sys, gc, uio, version, ngu
 from public_constants import MAX_TXN_LEN, MSG_SIGNING_MAX_LENGTH, SUPPORTED_ADDR_FORMATS
 from public_constants import AFC_SCRIPT, AF_CLASSIC, AFC_BECH32, AF_P2WPKH
 from public_constants import STXN_FLAGS_MASK, STXN_FINALIZE, STXN_VISUALIZE, STXN_SIGNED
-from sffile import SFFile
+from sffile import SFFile, start_erase
 from ux import ux_aborted, ux_show_story, abort_and_goto, ux_dramatic_pause, ux_clear_keys
 from usb import CCBusyError
 from utils import HexWriter, xfp2str, problem_file_line, cleanup_deriv_path, B2A
@@ -18,6 +18,10 @@ from exceptions import HSMDenied
 TXN_INPUT_OFFSET = 0
 TXN_OUTPUT_OFFSET = MAX_TXN_LEN
 
+# With dual_slots HSM policy, both areas are split in half, so the next PSBT
+# can be uploaded while another is signed, or its result downloaded.
+TXN_SLOT_LEN = MAX_TXN_LEN // 2
+
 class UserAuthorizedAction:
     active_request = None
 
@@ -358,9 +362,18 @@ def sign_txt_file(filename):
 
 
 class ApproveTransaction(UserAuthorizedAction):
-    def __init__(self, psbt_len, flags=0x0, approved_cb=None, psbt_sha=None):
+    def __init__(self, psbt_len, flags=0x0, approved_cb=None, psbt_sha=None, slot=None):
         super().__init__()
         self.psbt_len = psbt_len
+        if slot is None:
+            # whole area
+            self.in_offset = TXN_INPUT_OFFSET
+            self.out_offset = TXN_OUTPUT_OFFSET
+            self.max_len = MAX_TXN_LEN
+        else:
+            self.in_offset = TXN_INPUT_OFFSET + (slot * TXN_SLOT_LEN)
+            self.out_offset = TXN_OUTPUT_OFFSET + (slot * TXN_SLOT_LEN)
+            self.max_len = TXN_SLOT_LEN
         self.do_finalize = bool(flags & STXN_FINALIZE)
         self.do_visualize = bool(flags & STXN_VISUALIZE)
         self.stxn_flags = flags
@@ -368,8 +381,19 @@ class ApproveTransaction(UserAuthorizedAction):
         self.psbt_sha = psbt_sha
         self.approved_cb = approved_cb
         self.result = None      # will be (len, sha256) of the resulting PSBT
+        self.erase_task = None  # erasing space for that, in background
         self.chain = chains.current_chain()
 
+    def done(self, redraw=True):
+        # Refused, failed or finished: the background erase must not outlive us,
+        # or it keeps holding the flash under whatever request comes next.
+        # - cancel is a no-op once the task has completed (approve path)
+        if self.erase_task:
+            self.erase_task.cancel()
+            self.erase_task = None
+
+        super().done(redraw)
+
     def render_output(self, o):
         # Pretty-print a transactions output. 
         # - expects CTxOut object
@@ -381,6 +405,37 @@ class ApproveTransaction(UserAuthorizedAction):
         return '%s\n - to address -\n%s\n' % (val, dest)
 
 
+    def render_story(self):
+        # Text for humans to review: outputs, fee, change and warnings
+        # - also kept in the HSM log
+        msg = uio.StringIO()
+
+        # mention warning at top
+        wl= len(self.psbt.warnings)
+        if wl == 1:
+            msg.write('(1 warning below)\n\n')
+        elif wl >= 2:
+            msg.write('(%d warnings below)\n\n' % wl)
+
+        self.output_summary_text(msg)
+        gc.collect()
+
+        fee = self.psbt.calculate_fee()
+        if fee is not None:
+            msg.write("\nNetwork fee:\n%s %s\n" % self.chain.render_value(fee))
+
+        # NEW: show where all the change outputs are going
+        self.output_change_text(msg)
+        gc.collect()
+
+        if self.psbt.warnings:
+            msg.write('\n---WARNING---\n\n')
+
+            for label, m in self.psbt.warnings:
+                msg.write('- %s: %s\n\n' % (label, m))
+
+        return msg
+
     async def interact(self):
         # Prompt user w/ details and get approval
         from glob import dis, hsm_active
@@ -389,7 +444,7 @@ class ApproveTransaction(UserAuthorizedAction):
 
         try:
             dis.fullscreen("Reading...")
-            with SFFile(TXN_INPUT_OFFSET, length=self.psbt_len) as fd:
+            with SFFile(self.in_offset, length=self.psbt_len) as fd:
                 self.psbt = psbtObject.read_psbt(fd)
         except BaseException as exc:
             if isinstance(exc, MemoryError):
@@ -426,6 +481,10 @@ class ApproveTransaction(UserAuthorizedAction):
 
             return await self.failure(msg, exc)
 
+        if not self.do_visualize and not self.approved_cb:
+            # Clear space for signed result, while they think about it.
+            self.erase_task = start_erase(self.out_offset, self.max_len)
+
         # step 2: figure out what we are approving, so we can get sign-off
         # - outputs, amounts
         # - fee 
@@ -438,31 +497,11 @@ class ApproveTransaction(UserAuthorizedAction):
         #       - inputs we can't sign (no key)
         #
         try:
-            msg = uio.StringIO()
-
-            # mention warning at top
-            wl= len(self.psbt.warnings)
-            if wl == 1:
-                msg.write('(1 warning below)\n\n')
-            elif wl >= 2:
-                msg.write('(%d warnings below)\n\n' % wl)
-
-            self.output_summary_text(msg)
-            gc.collect()
-
-            fee = self.psbt.calculate_fee()
-            if fee is not None:
-                msg.write("\nNetwork fee:\n%s %s\n" % self.chain.render_value(fee))
-
-            # NEW: show where all the change outputs are going
-            self.output_change_text(msg)
-            gc.collect()
-
-            if self.psbt.warnings:
-                msg.write('\n---WARNING---\n\n')
-
-                for label, m in self.psbt.warnings:
-                    msg.write('- %s: %s\n\n' % (label, m))
+            if hsm_active and not self.do_visualize and not hsm_active.needs_story:
+                # policy has no use for the text, so don't render it
+                msg = None
+            else:
+                msg = self.render_story()
 
             if self.do_visualize:
                 # stop here and just return the text of approval message itself
@@ -476,7 +515,8 @@ class ApproveTransaction(UserAuthorizedAction):
                 msg.write("\nPress OK to approve and sign transaction. X to abort.")
                 ch = await ux_show_story(msg, title="OK TO SEND?")
             else:
-                ch = await hsm_active.approve_transaction(self.psbt, self.psbt_sha, msg.getvalue())
+                ch = await hsm_active.approve_transaction(self.psbt, self.psbt_sha,
+                                                            msg.getvalue() if msg else None)
                 dis.progress_bar(1)     # finish the Validating...
 
         except MemoryError:
@@ -523,8 +563,11 @@ class ApproveTransaction(UserAuthorizedAction):
         txid = None
         try:
             # re-serialize the PSBT back out
-            with SFFile(TXN_OUTPUT_OFFSET, max_size=MAX_TXN_LEN, message="Saving...") as fd:
-                await fd.erase()
+            # - area was erased in background, might still be finishing that
+            await self.erase_task
+
+            with SFFile(self.out_offset, max_size=self.max_len, message="Saving...",
+                                                                pre_erased=True) as fd:
 
                 if self.do_finalize:
                     txid = self.psbt.finalize(fd)
@@ -550,7 +593,7 @@ class ApproveTransaction(UserAuthorizedAction):
 
         chk = self.chain.hash_message(msg_len=txt_len) if sign_text else None
 
-        with SFFile(TXN_OUTPUT_OFFSET, max_size=txt_len+300, message="Visualizing...") as fd:
+        with SFFile(self.out_offset, max_size=txt_len+300, message="Visualizing...") as fd:
             await fd.erase()
 
             while 1:
@@ -672,10 +715,12 @@ class ApproveTransaction(UserAuthorizedAction):
             msg.write('%s %s\n' % self.chain.render_value(mtot))
 
 
-def sign_transaction(psbt_len, flags=0x0, psbt_sha=None):
+def sign_transaction(psbt_len, flags=0x0, psbt_sha=None, slot=None):
     # transaction (binary) loaded into sflash already, checksum checked
+    # - slot is 0 or 1 in dual-slot mode, else None
     UserAuthorizedAction.check_busy(ApproveTransaction)
-    UserAuthorizedAction.active_request = ApproveTransaction(psbt_len, flags, psbt_sha=psbt_sha)
+    UserAuthorizedAction.active_request = ApproveTransaction(psbt_len, flags,
+                                                    psbt_sha=psbt_sha, slot=slot)
 
     # kill any menu stack, and put our thing at the top
     abort_and_goto(UserAuthorizedAction.active_request)
@@ -748,6 +793,9 @@ def sign_psbt_file(filename):
             assert total <= psbt_len
             psbt_len = total
 
+            # hashed as it was written, no need to read it back
+            psbt_sha = out.checksum.digest()
+
     async def done(psbt):
         orig_path, basename = filename.rsplit('/', 1)
         orig_path += '/'
@@ -852,7 +900,8 @@ def sign_psbt_file(filename):
 
         UserAuthorizedAction.cleanup()
 
-    UserAuthorizedAction.active_request = ApproveTransaction(psbt_len, approved_cb=done)
+    UserAuthorizedAction.active_request = ApproveTransaction(psbt_len, approved_cb=done,
+                                                                    psbt_sha=psbt_sha)
 
     # kill any menu stack, and put our thing at the top
     abort_and_goto(UserAuthorizedAction.active_request)
@@ -77,7 +77,7 @@ def render_backup_contents():
     COMMENT('User preferences')
 
     # user preferences
-    for k,v in settings.current.items():
+    for k,v in settings.all_values().items():
         if k[0] == '_': continue        # debug stuff in simulator
         if k == 'xpub': continue        # redundant, and wrong if bip39pw
         if k == 'xfp': continue         # redundant, and wrong if bip39pw
@@ -207,6 +207,44 @@ class ChainsBase:
 
         raise ValueError('Unknown payment script', repr(script))
 
+    @staticmethod
+    def is_payment_script(script):
+        # Would render_address() work on this script? Cheaper than doing it.
+        ll = len(script)
+
+        return ((ll == 25 and script[0:3] == b'\x76\xA9\x14' and script[23:26] == b'\x88\xAC')
+                or (ll == 23 and script[0:2] == b'\xA9\x14' and script[22] == 0x87)
+                or (ll == 22 and script[0:2] == b'\x00\x14')
+                or (ll == 34 and script[0:2] == b'\x00\x20'))
+
+    @classmethod
+    def script_for_address(cls, addr):
+        # Reverse of render_address(): scriptPubKey which pays to that address.
+        # - returns None if not for this chain, or not a type we would render
+        try:
+            raw = ngu.codecs.b58_decode(addr)
+        except:
+            raw = None
+
+        if raw:
+            if len(raw) != 21:
+                return None
+            if raw[0:1] == cls.b58_addr:
+                return b'\x76\xA9\x14' + raw[1:] + b'\x88\xAC'
+            if raw[0:1] == cls.b58_script:
+                return b'\xA9\x14' + raw[1:] + b'\x87'
+            return None
+
+        try:
+            hrp, version, data = ngu.codecs.segwit_decode(addr)
+        except:
+            return None
+
+        if hrp != cls.bech32_hrp or version != 0 or len(data) not in (20, 32):
+            return None
+
+        return bytes([0, len(data)]) + data
+
 class BitcoinMain(ChainsBase):
     # see <https://github.com/bitcoin/bitcoin/blob/master/src/chainparams.cpp#L140>
     ctype = 'BTC'
@@ -14,5 +14,9 @@ numpad = None
 # global ptr to HSM policy, if any (supported on Mk3+ only)
 hsm_active = None
 
+# boot profile: (label, ticks_ms, modules loaded, deferred modules loaded, heap used)
+# - see main.boot_mark()
+boot_profile = []
+
 
 # EOF
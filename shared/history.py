@@ -2,67 +2,133 @@
 #
 # history.py - store some history about past transactions and/or outputs they involved
 #
-import gc, chains
-from utils import B2A
+import gc, chains, aes256ctr
 from uhashlib import sha256
 from ustruct import pack, unpack
 from exceptions import IncorrectUTXOAmount
-from ubinascii import b2a_base64, a2b_base64
+from ubinascii import a2b_base64
 from serializations import COutPoint, uint256_from_str
-from nvstore import settings
+from nvstore import settings, HISTORY_RING as RING
+from sflash import SF
 
-# Very limited space in serial flash, so we compress as much as possible:
+# length of hashed&encoded key, as stored by older versions (base64(15 bytes) => 20)
+ENCKEY_LEN = const(20)
+
+# Outpoint values are kept in a ring of small records in SPI flash, outside the settings:
 # - would be bad for privacy to store these **UTXO amounts** in plaintext
-# - result is stored in a JSON serialization, so needs to be text encoded
-# - using base64, in two parts, concatenated
-#       - 15 bytes are hash over txnhash:out_num => base64 => 20 chars text
-#       - 8 bytes exact satoshi value => base64 (pad trimmed) => 11 chars
-# - stored satoshi value is XOR'ed with LSB from prevout txn hash, which isn't stored
-# - result is a 31 character string for each history entry, plus 4 overhead => 35 each
-# - if we store 30 of those it's about 25% of total setting space
+# - each 32-byte record is AES-CTR encrypted w/ the settings key, CTR based on position
+#   - 15 bytes are hash over txnhash:out_num
+#   - 8 bytes exact satoshi value, XOR'ed with LSB from prevout txn hash, which isn't stored
+#   - 9 zero bytes, so we can tell our records from noise/other wallets
+# - one sector is erased as ring wraps around, losing oldest 128 entries
+# - in memory, index from (part of) hash to record position
 #
-HISTORY_SAVED = const(30)
-HISTORY_MAX_MEM = const(128)
-
-# length of hashed&encoded key only (base64(15 bytes) => 20)
-ENCKEY_LEN = const(20)
+ENTRY_LEN = const(32)
+ENTRY_KEY_LEN = const(15)
 
 class OutptValueCache:
-    # storing a list in settings
-    # - maps from hash of txid:n to expected sats there
-    # - stored as b64 key concatenated w/ int
+    # maps from hash of txid:n to expected sats there
+    # - older versions stored list in settings under this key, as
+    #   base64 key concatenated w/ int
     KEY = 'ovc'
 
-    # we keep extra entries here during the current power-up
-    # as defense against using very large txn in the attack
-    runtime_cache = []
-    _cache_loaded = False
+    # index: first 30 bits of key => position in ring
+    table = {}
+
+    # settings key the table was built with, next ring position to write
+    _loaded_key = None
+    head = RING.start
 
     @classmethod
     def clear(cls):
         # user action in danger zone menu
-        cls.runtime_cache.clear()
-        cls._cache_loaded = True
+        # - other wallets' records are lost too
+        for pos in range(RING.start, RING.stop, SF.BLOCK_SIZE):
+            SF.block_erase(pos)
+            SF.wait_done()
+
+        cls.table.clear()
+        cls.head = RING.start
+        cls._loaded_key = settings.nvram_key
+
         settings.remove_key(cls.KEY)
-        settings.save()
+
+    @classmethod
+    def entry_aes(cls, pos):
+        return aes256ctr.new(settings.nvram_key, pack('<4I', 6, 3, 2, pos))
+
+    @classmethod
+    def read_entry(cls, pos, buf=None):
+        # decrypt a record, return (key, value) if it's ours, else None
+        if buf is None:
+            buf = bytearray(ENTRY_LEN)
+            SF.read(pos, buf)
+
+        if buf[0] == buf[1] == buf[2] == buf[3] == 0xff:
+            # erased
+            return None
+
+        d = cls.entry_aes(pos).cipher(buf)
+        if d[ENTRY_KEY_LEN+8:] != bytes(ENTRY_LEN-ENTRY_KEY_LEN-8):
+            return None
+
+        return d[0:ENTRY_KEY_LEN], d[ENTRY_KEY_LEN:ENTRY_KEY_LEN+8]
+
+    @staticmethod
+    def index_key(key):
+        # small int, so no allocation for each entry in table
+        return unpack('<I', key[0:4])[0] & 0x3fffffff
 
     @classmethod
     def load_cache(cls):
-        # first time: read saved value, but rest of time; use what's in memory
-        if not cls._cache_loaded:
-            saved = settings.get(cls.KEY) or []
-            cls.runtime_cache.extend(saved)
-            cls._cache_loaded = True
-    
+        # first time (for this wallet): scan ring, and index records that are ours
+        if cls._loaded_key == settings.nvram_key:
+            return
+
+        cls.table.clear()
+        cls._loaded_key = settings.nvram_key
+
+        # head is first erased record, after a written one (ring: last is before first)
+        head = None
+        buf = bytearray(1024)
+        SF.read(RING[-1], memoryview(buf)[0:4])
+        was_blank = (buf[0] == buf[1] == buf[2] == buf[3] == 0xff)
+
+        for base in range(RING.start, RING.stop, len(buf)):
+            SF.read(base, buf)
+
+            for off in range(0, len(buf), ENTRY_LEN):
+                here = memoryview(buf)[off:off+ENTRY_LEN]
+                got = cls.read_entry(base+off, here)
+                if got:
+                    cls.table[cls.index_key(got[0])] = base+off
+
+                blank = (here[0] == here[1] == here[2] == here[3] == 0xff)
+                if blank and not was_blank and head is None:
+                    head = base+off
+                was_blank = blank
+
+        cls.head = head or RING.start
+
+        gc.collect()
+
+        # import from older versions
+        saved = settings.get(cls.KEY)
+        if saved:
+            for v in saved:
+                key = a2b_base64(v[0:ENCKEY_LEN])
+                if cls.index_key(key) not in cls.table:
+                    cls.append(key, a2b_base64(v[ENCKEY_LEN:] + '='))
+
+            settings.remove_key(cls.KEY)
 
     @classmethod
     def encode_key(cls, prevout):
-        # hash up the txid and output number, truncate, and encode as base64
-        # - truncating at (mod3) bytes so no padding on b64 output
+        # hash up the txid and output number, and truncate
         # - expects a COutPoint
         md = sha256('OutptValueCache')
         md.update(prevout.serialize())
-        return b2a_base64(md.digest()[:15])[:-1].decode()
+        return md.digest()[:ENTRY_KEY_LEN]
 
     @classmethod
     def encode_value(cls, prevout, amt):
@@ -70,13 +136,12 @@ class OutptValueCache:
         xor = pack('<Q', prevout.hash & ((1<<64)-1))
         val = bytes(i^j for i,j in zip(xor, pack('<Q', amt)))
         assert len(val) == 8
-        return b2a_base64(val)[:-2].decode()
+        return val
 
     @classmethod
-    def decode_value(cls, prevout, text):
-        # base64 decode, xor w/ hash, decode as uint64
+    def decode_value(cls, prevout, val):
+        # xor w/ hash, decode as uint64
         xor = pack('<Q', prevout.hash & ((1<<64)-1))
-        val = a2b_base64(text + '=')
         assert len(val) == 8
         val = bytes(i^j for i,j in zip(xor, val))
         return unpack('<Q', val)[0]
@@ -86,15 +151,20 @@ class OutptValueCache:
         # Return the amount we expect for this utxo, if we have it, else None
         cls.load_cache()
 
-        if not cls.runtime_cache:
+        if not cls.table:
             return None
 
         key = cls.encode_key(prevout)
-        for v in cls.runtime_cache:
-            if v[0:ENCKEY_LEN] == key:
-                return cls.decode_value(prevout, v[ENCKEY_LEN:])
+        pos = cls.table.get(cls.index_key(key))
+        if pos is None:
+            return None
 
-        return None
+        # check full key; could be other entry w/ same index
+        got = cls.read_entry(pos)
+        if not got or got[0] != key:
+            return None
+
+        return cls.decode_value(prevout, got[1])
 
     @classmethod
     def verify_amount(cls, prevout, amount, in_idx):
@@ -118,29 +188,40 @@ class OutptValueCache:
                                                 exp, amount, units))
 
     @classmethod
-    def add(cls, prevout, amount):
-        # protect privacy, compress a little, and save it.
-        # - we know it's not yet in our lists
-        key = cls.encode_key(prevout)
+    def append(cls, key, val):
+        # write new record at head of ring
+        pos = cls.head
 
-        # memory management: can't store very much, so trim as needed
-        depth = HISTORY_SAVED
-        if settings.capacity > 0.8:
-            depth //= 2
+        if pos % 4096 == 0:
+            # starting new sector: erase it, and forget what it held
+            for k, p in list(cls.table.items()):
+                if pos <= p < pos+4096:
+                    del cls.table[k]
 
-        # also limit in-memory use
-        cls.load_cache()
-        if len(cls.runtime_cache) >= HISTORY_MAX_MEM:
-            del cls.runtime_cache[0]
+            SF.sector_erase(pos)
+            SF.wait_done()
+
+        rec = bytearray(ENTRY_LEN)
+        rec[0:ENTRY_KEY_LEN] = key
+        rec[ENTRY_KEY_LEN:ENTRY_KEY_LEN+8] = val
+
+        SF.write(pos, cls.entry_aes(pos).cipher(rec))
+        SF.wait_done()
+
+        cls.table[cls.index_key(key)] = pos
+
+        cls.head = pos + ENTRY_LEN
+        if cls.head >= RING.stop:
+            cls.head = RING.start
 
-        # save new addition
-        assert len(key) == ENCKEY_LEN
+    @classmethod
+    def add(cls, prevout, amount):
+        # protect privacy, compress a little, and save it.
+        # - we know it's not yet in our lists
         assert amount > 0
-        entry = key + cls.encode_value(prevout, amount)
-        cls.runtime_cache.append(entry)
 
-        # update what we're going to save long-term
-        settings.set(cls.KEY, cls.runtime_cache[-depth:])
+        cls.load_cache()
+        cls.append(cls.encode_key(prevout), cls.encode_value(prevout, amount))
 
 # As we build new transaction, track what we need to capture
 new_outpts = []
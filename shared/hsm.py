@@ -4,19 +4,22 @@
 #
 # Unattended signing of transactions and messages, subject to a set of rules.
 #
-import stash, ustruct, chains, sys, gc, uio, ujson, uos, utime, ckcc, ngu
+import stash, ustruct, chains, sys, gc, uio, ujson, uos, utime, ckcc, ngu, pyb
 from sffile import SFFile
 from utils import problem_file_line, cleanup_deriv_path, match_deriv_path
+from utils import hsm_policy_available, HSM_POLICY_FNAME as POLICY_FNAME
 from pincodes import AE_LONG_SECRET_LEN
 from stash import blank_object
 from users import Users, MAX_NUMBER_USERS, calc_local_pincode
-from public_constants import MAX_USERNAME_LEN
+from public_constants import MAX_USERNAME_LEN, MAX_TXN_LEN
 from multisig import MultisigWallet
 from ubinascii import hexlify as b2a_hex
 from files import CardSlot, CardMissingError
+from nvstore import settings
 
-# where we save policy/config
-POLICY_FNAME = '/flash/hsm-policy.json'
+# optional single log file on MicroSD (relative to root), and size where it gets rolled
+ROLLING_LOG_FNAME = 'hsm-audit.log'
+ROLLING_LOG_SIZE = const(1024*1024)
 
 # number of digits in our "local confirmation" pin
 LOCAL_PIN_LENGTH = 6
@@ -31,14 +34,6 @@ ABSOLUTE_MAX_REFUSALS = const(100)
 # mode, if you enable the boot_to_hsm feature
 BOOT_LOCKOUT_TIME = const(60)
 
-def hsm_policy_available():
-    # Is there an HSM policy ready to go? Offer the menu item then.
-    try:
-        uos.stat(POLICY_FNAME)
-        return True
-    except:
-        return False
-
 def hsm_delete_policy():
     # un-install HSM policy file.
     try:
@@ -119,7 +114,7 @@ def assert_empty_dict(j):
 
 def cleanup_whitelist_value(s):
     # one element in a list of addresses or paths or descriptors?
-    # - later matching is string-based, so just doing basic syntax check here
+    # - just doing basic syntax check here, see compile_whitelist()
     # - must be checksumed-base58 or bech32
     try:
         ngu.codecs.b58_decode(s)
@@ -133,6 +128,19 @@ def cleanup_whitelist_value(s):
 
     raise ValueError('bad whitelist value: ' + s)
 
+def compile_whitelist(whitelist):
+    # Convert addresses into the scriptPubKey's which would pay to them,
+    # so we can match directly against transaction outputs.
+    # - addresses for other chains can never match, so are dropped
+    chain = chains.current_chain()
+    rv = set()
+    for addr in whitelist:
+        script = chain.script_for_address(addr)
+        if script:
+            rv.add(script)
+
+    return rv
+
 class ApprovalRule:
     # A rule which describes transactions we are okay with approving. It documents:
     # - whitelist: list of destination addresses allowed (or None=any)
@@ -156,7 +164,9 @@ class ApprovalRule:
         self.per_period = pop_int(j, 'per_period', 0, MAX_SATS)
         self.max_amount = pop_int(j, 'max_amount', 0, MAX_SATS)
         self.users = pop_list(j, 'users', check_user)
+        self.user_set = set(self.users)
         self.whitelist = pop_list(j, 'whitelist', cleanup_whitelist_value)
+        self.whitelist_scripts = compile_whitelist(self.whitelist)
         self.min_users = pop_int(j, 'min_users', 1, len(self.users))
         self.local_conf = pop_bool(j, 'local_conf')
         self.wallet = pop_string(j, 'wallet', 1, 20)
@@ -232,8 +242,49 @@ class ApprovalRule:
 
         return rv
 
+    def quick_match(self, users, total_out, dests, local_oked, explain=False):
+        # Does this rule allow the txn? Wallet is already known to match
+        # (see HSMPolicy.index_rules). Gives False at first failed test, or
+        # when explaining, raises AssertionError with the reason instead.
+        # - cheap scalar tests first, then sets
+        if self.max_amount is not None and total_out > self.max_amount:
+            assert not explain, 'amount exceeded'
+            return False
+
+        if self.per_period is not None and self.spent_so_far + total_out > self.per_period:
+            # this txn would exceed the velocity limit
+            assert not explain, 'would exceed period spending'
+            return False
+
+        if self.local_conf and not local_oked:
+            # local user must approve
+            assert not explain, "local operator didn't confirm"
+            return False
+
+        if self.users:
+            # some remote users need to approve
+            given = len(self.user_set.intersection(users))
+            if not given:
+                assert not explain, 'need user(s) confirmation'
+                return False
+            if given < self.min_users:
+                assert not explain, 'need more users to confirm (got %d of %d)' % (
+                                        given, self.min_users)
+                return False
+
+        # check all destinations are in the whitelist
+        # - dests are scriptPubKey values; address only needed for the error
+        if self.whitelist:
+            for d in dests:
+                if d not in self.whitelist_scripts:
+                    assert not explain, "non-whitelisted address: " + \
+                                    chains.current_chain().render_address(d)
+                    return False
+
+        return True
+
     def matches_transaction(self, psbt, users, total_out, dests, local_oked):
-        # Does this rule apply to this PSBT file? 
+        # Does this rule apply to this PSBT file? Raises with the reason if not.
         if self.wallet:
             # rule limited to one wallet
             if psbt.active_multisig:
@@ -243,54 +294,154 @@ class ApprovalRule:
                 # non multisig, but does this rule apply to all wallets or single-singers
                 assert self.wallet == '1', 'not multisig'
 
-        if self.max_amount is not None:
-            assert total_out <= self.max_amount, 'amount exceeded'
+        return self.quick_match(users, total_out, dests, local_oked, explain=True)
+
+class LogCard:
+    # Keeps the MicroSD card mounted, and the current log file open, between
+    # requests while in HSM mode. Re-mounts if the card is changed, and
+    # released when HSM mode ends (see hsm_ux) or on any write error.
+    # - HSM needs Mk3, where keypad is membrane not touch: card power is no problem
+    card = None
+    changed = None
+    dirs = set()
+    fd = None
+    fname = None
+    size = 0
+
+    @classmethod
+    def _still_good(cls):
+        # same card, still inserted and mounted?
+        if CardSlot.last_change != cls.changed:
+            return False
 
-        # check all destinations are in the whitelist
-        if self.whitelist:
-            diff = set(dests) - set(self.whitelist)
-            assert not diff, "non-whitelisted address: " + diff.pop()
+        if not pyb.SDCard().present():
+            return False
 
-        if self.local_conf:
-            # local user must approve
-            assert local_oked, "local operator didn't confirm"
+        if ckcc.is_simulator():
+            return True
 
-        if self.users:
-            # some remote users need to approve
-            given = set(self.users).intersection(users)
-            assert given, 'need user(s) confirmation'
-            assert len(given) >= self.min_users, 'need more users to confirm (got %d of %d)'%(
-                                        len(given), self.min_users)
+        try:
+            uos.statvfs('/sd')
+            return True
+        except OSError:
+            return False
 
-        if self.per_period is not None:
-            # check this txn would not exceed the velocity limit
-            assert self.spent_so_far + total_out <= self.per_period, 'would exceed period spending'
+    @classmethod
+    def mount(cls):
+        # may raise CardMissingError
+        if cls.card and not cls._still_good():
+            cls.release()
+
+        if not cls.card:
+            cls.card = CardSlot().__enter__()
+            cls.changed = CardSlot.last_change
+            cls.dirs = set()
+        elif cls.card.active_led:
+            cls.card.active_led.on()
+
+        return cls.card
+
+    @classmethod
+    def mkdir(cls, d):
+        # mkdir if needed, but only check once per mount
+        if d in cls.dirs:
+            return
+
+        try: uos.stat(d)
+        except: uos.mkdir(d)
+
+        cls.dirs.add(d)
+
+    @classmethod
+    def open(cls, fname):
+        # get an (append mode) file on the card; may raise CardMissingError, OSError
+        cls.mount()
+
+        if cls.fname != fname:
+            if cls.fd:
+                cls.fd.close()
+                cls.fd = cls.fname = None
+
+            cls.fd = open(fname, 'a+t')
+            cls.fname = fname
+            cls.size = uos.stat(fname)[6]
+
+        return cls.card
+
+    @classmethod
+    def roll(cls, limit):
+        # rename a full log file to .old and start over
+        if cls.size < limit:
+            return
+
+        fname = cls.fname
+        cls.fd.close()
+        cls.fd = cls.fname = None
+
+        try: uos.remove(fname + '.old')
+        except OSError: pass
+        uos.rename(fname, fname + '.old')
+
+        cls.open(fname)
+
+    @classmethod
+    def write(cls, data):
+        # one write per record; flush() is f_sync() in FatFs, which also
+        # updates the FAT and directory entry, so the record survives power loss
+        cls.fd.write(data)
+        cls.fd.flush()
+        cls.size += len(data)
+
+        if cls.card.active_led:
+            cls.card.active_led.off()
+
+    @classmethod
+    def release(cls):
+        # unmount and unpower card; next request will try again
+        try:
+            if cls.fd:
+                cls.fd.close()
+        except OSError:
+            pass
 
-        return True
+        if cls.card:
+            cls.card.recover()
+
+        cls.card = cls.fd = cls.fname = None
 
 class AuditLogger:
-    def __init__(self, dirname, digest, never_log):
+    def __init__(self, dirname, digest, never_log, rolling=False):
         self.dirname = dirname
         self.digest = digest
         self.never_log = never_log
+        self.rolling = rolling
 
     def __enter__(self):
         try:
             if self.never_log:
                 raise NotImplementedError
 
-            self.card = CardSlot().__enter__()
+            self.fd = uio.StringIO()
+
+            root = LogCard.mount().get_sd_root()
 
-            d  = self.card.get_sd_root() + '/' + self.dirname
+            if self.rolling:
+                # single file for all records, renamed to .old when large
+                self.fname = root + '/' + ROLLING_LOG_FNAME
+                self.card = LogCard.open(self.fname)
+                LogCard.roll(ROLLING_LOG_SIZE)
+            else:
+                d = root + '/' + self.dirname
+                LogCard.mkdir(d)
 
-            # mkdir if needed
-            try: uos.stat(d)
-            except: uos.mkdir(d)
-                
-            self.fname = d + '/' + b2a_hex(self.digest[-8:]).decode('ascii') + '.log'
-            self.fd = open(self.fname, 'a+t')       # append mode
-        except (CardMissingError, OSError, NotImplementedError):
+                self.fname = d + '/' + b2a_hex(self.digest[-8:]).decode('ascii') + '.log'
+                self.card = LogCard.open(self.fname)
+
+        except (CardMissingError, OSError, NotImplementedError) as exc:
             # may be fatal or not, depending on configuration
+            if not isinstance(exc, NotImplementedError):
+                LogCard.release()
+
             self.fname = self.card = None
             self.fd = sys.stdout
 
@@ -305,16 +456,23 @@ class AuditLogger:
 
         if self.card:
             assert self.fd != sys.stdout
-            self.fd.close()
-            self.card.__exit__(exc_type, exc_value, traceback)
+            try:
+                LogCard.write(self.fd.getvalue())
+                self.fd = None
+            except OSError as exc:
+                # card pulled, full, etc: record is lost, see HSMPolicy.was_logged
+                LogCard.release()
+                self.card = None
+                self.fd = sys.stdout
+                print("Log write failed: %s" % exc)
 
     @property
     def is_unsaved(self):
         return not self.card
 
     def info(self, msg):
+        # buffered in RAM until end of request
         print(msg, file=self.fd)
-        #if self.fd != sys.stdout: print(msg)
 
 class HSMPolicy:
     # implements and enforces the HSM signing/activity/logging policy
@@ -329,8 +487,10 @@ class HSMPolicy:
         self.start_time = 0
 
         # velocity limits
+        # - kept in RAM only: spending never causes a flash write, and after a
+        #   reboot we assume the period is used up (see activate)
         self.period_started = 0
-        self.period_spends = {}
+        self.velocity_rules = []
 
         # haven't entered anything yet
         self.local_code_pending = ''
@@ -348,6 +508,15 @@ class HSMPolicy:
         assert not (self.must_log and self.never_log), 'log conflict'
         self.priv_over_ux = pop_bool(j, 'priv_over_ux')
 
+        # log a short record of each txn, rather than the full story
+        self.compact_log = pop_bool(j, 'compact_log')
+
+        # append all records to one file on the card, rather than file per request
+        self.rolling_log = pop_bool(j, 'rolling_log')
+
+        # split PSBT area in two, so next can be uploaded during signing
+        self.dual_slots = pop_bool(j, 'dual_slots')
+
         # don't fail on PSBT warnings
         self.warnings_ok = pop_bool(j, 'warnings_ok')
 
@@ -375,13 +544,54 @@ class HSMPolicy:
         # complex txn approval rules
         lst = pop_list(j, 'rules') or []
         self.rules = [ApprovalRule(i, idx) for idx, i in enumerate(lst)]
+        self.index_rules()
 
-        if not self.period and any(i.has_velocity for i in self.rules):
+        if not self.period and self.velocity_rules:
             raise ValueError("Needs period to be specified")
 
         # error checking, must be last!
         assert_empty_dict(j)
 
+    def index_rules(self):
+        # Group rules by the wallet they apply to, keeping priority order, and
+        # note the largest amount any rule in the group would allow.
+        # - key is multisig wallet name, or '1' for single signer; None for other wallets
+        # - must be called again if self.rules is changed
+        keys = set(r.wallet for r in self.rules)
+        keys.update([None, '1'])
+
+        self.rule_index = {}
+        for k in keys:
+            lst = [r for r in self.rules if r.wallet in (None, k)]
+            amts = [r.max_amount for r in lst]
+            ceiling = max(amts) if (amts and None not in amts) else None
+
+            self.rule_index[k] = (ceiling, lst)
+
+        # only these rules need velocity accounting
+        self.velocity_rules = [r for r in self.rules if r.has_velocity]
+
+    def pick_rule(self, psbt, users, total_out, dests, local_oked):
+        # Find first rule (in priority order) that allows this txn, or None
+        ms = psbt.active_multisig
+        key = ms.name if ms else '1'
+        ceiling, rules = self.rule_index.get(key) or self.rule_index[None]
+
+        if ceiling is not None and total_out > ceiling:
+            return None
+
+        for rule in rules:
+            if rule.quick_match(users, total_out, dests, local_oked):
+                return rule
+
+        return None
+
+    @property
+    def needs_story(self):
+        # Do we want the full text of the transaction, as shown to humans?
+        # It's only used for the log.
+        return not (self.never_log or self.compact_log)
+
     def period_reset_time(self):
         # Time from now, in seconds, until the period resets and the velocity
         # totals are reset
@@ -392,7 +602,8 @@ class HSMPolicy:
     def save(self):
         # Create JSON document for next time.
         simple = ['must_log', 'never_log', 'msg_paths', 'share_xpubs', 'share_addrs',
-                    'notes', 'period', 'allow_sl', 'warnings_ok', 'boot_to_hsm', 'priv_over_ux']
+                    'notes', 'period', 'allow_sl', 'warnings_ok', 'boot_to_hsm', 'priv_over_ux',
+                    'compact_log', 'rolling_log', 'dual_slots']
         rv = dict()
         for fn in simple:
             rv[fn] = getattr(self, fn, None)
@@ -440,9 +651,16 @@ class HSMPolicy:
         if not self.never_log:
             fd.write('- MicroSD card %s receive log entries.\n' 
                                     % ('MUST' if self.must_log else 'will'))
+            if self.compact_log:
+                fd.write('- Log entries for transactions will be compact.\n')
+            if self.rolling_log:
+                fd.write('- Log entries go into a single file: %s\n' % ROLLING_LOG_FNAME)
         else:
             fd.write("- No logging.\n")
 
+        if self.dual_slots:
+            fd.write('- Two PSBT upload slots, each up to %dk.\n' % (MAX_TXN_LEN // 2048))
+
         if self.set_sl:
             fd.write('- Storage Locker will be updated, and can be read %d times.\n'
                             % self.allow_sl)
@@ -529,18 +747,20 @@ class HSMPolicy:
             # In boot-to-HSM mode, we cant be sure PIN holder has authority
             # to spend, so maybe they are rebooting to reset the period.
             # Assume period has already been used up (conservative model)
-            for r in self.rules:
+            for r in self.velocity_rules:
                 if r.per_period:
                     self.record_spend(r, r.per_period)
 
     def reset_period(self):
         # new period has begun
-        for r in self.rules:
-            r.spent_so_far = 0
+        if self.period_started:
+            for r in self.velocity_rules:
+                r.spent_so_far = 0
         self.period_started = 0
 
     def record_spend(self, rule, amt):
         # record they spend some amount in this period
+        # - just a counter in RAM, nothing to save
         rule.spent_so_far += amt
         if not self.period_started:
             self.period_started = (utime.ticks_ms() // 1000) or 1
@@ -618,7 +838,7 @@ class HSMPolicy:
         # Maybe approve indicated message to be signed.
         # return 'y' or 'x'
         sha = ngu.hash.sha256s(msg_text)
-        with AuditLogger('messages', sha, self.never_log) as log:
+        with AuditLogger('messages', sha, self.never_log, self.rolling_log) as log:
 
             if self.must_log and log.is_unsaved:
                 self.refuse(log, "Could not log details, and must_log is set")
@@ -639,6 +859,9 @@ class HSMPolicy:
 
             self.approve(log, 'Message signing allowed')
 
+        if not self.was_logged(log):
+            return 'x'
+
         return 'y'
 
     def approve_xpub_share(self, subpath):
@@ -705,12 +928,13 @@ class HSMPolicy:
     async def approve_transaction(self, psbt, psbt_sha, story):
         # Approve or don't a transaction. Catch assertions and other
         # reasons for failing/rejecting into the log.
+        # - story can be None, see needs_story
         # - return 'y' or 'x'
         chain = chains.current_chain()
         assert psbt_sha and len(psbt_sha) == 32
         self.get_time_left()
 
-        with AuditLogger('psbt', psbt_sha, self.never_log) as log:
+        with AuditLogger('psbt', psbt_sha, self.never_log, self.rolling_log) as log:
 
             if self.must_log and log.is_unsaved:
                 self.refuse(log, "Could not log details, and must_log is set")
@@ -718,7 +942,8 @@ class HSMPolicy:
 
             log.info('Transaction signing requested:')
             log.info('SHA256(PSBT) = ' + b2a_hex(psbt_sha).decode('ascii'))
-            log.info('-vvv-\n%s\n-^^^-' % story)
+            if story is not None:
+                log.info('-vvv-\n%s\n-^^^-' % story)
 
             # reset pending auth list and "consume" it now
             auth = self.pending_auth
@@ -728,6 +953,22 @@ class HSMPolicy:
                 # do this super early so always cleared even if other issues
                 local_ok = self.consume_local_code(psbt_sha)
 
+                # Where is it going? (as scriptPubKey, not address)
+                total_out = 0
+                dests = []
+                for idx, tx_out in psbt.output_iter():
+                    if not psbt.outputs[idx].is_change:
+                        if not chain.is_payment_script(tx_out.scriptPubKey):
+                            raise ValueError('Unknown payment script')
+                        total_out += tx_out.nValue
+                        dests.append(tx_out.scriptPubKey)
+
+                if story is None and not self.never_log:
+                    # short record, in place of story
+                    addrs = [chain.render_address(d) for d in dests]
+                    log.info(ujson.dumps(dict(total_out=total_out, dests=addrs,
+                                    fee=psbt.calculate_fee(), warnings=len(psbt.warnings))))
+
                 if not self.rules:
                     raise ValueError("no txn signing allowed")
 
@@ -739,13 +980,16 @@ class HSMPolicy:
                         raise ValueError("has %d warning(s)" % len(psbt.warnings))
 
                 # See who has entered creditials already (all must be valid).
+                # - counter updates are saved together, once all checked
                 users = []
-                for u, (token, counter) in auth.items():
-                    problem = Users.auth_okay(u, token, totp_time=counter, psbt_hash=psbt_sha)
-                    if problem:
-                        self.refuse(log, "User '%s' gave wrong auth value: %s" % (u, problem))
-                        return 'x'
-                    users.append(u)
+                with settings.batch():
+                    for u, (token, counter) in auth.items():
+                        problem = Users.auth_okay(u, token, totp_time=counter,
+                                                    psbt_hash=psbt_sha)
+                        if problem:
+                            self.refuse(log, "User '%s' gave wrong auth value: %s" % (u, problem))
+                            return 'x'
+                        users.append(u)
 
                 # was right code provided locally? (also resets for next attempt)
                 if local_ok:
@@ -753,28 +997,21 @@ class HSMPolicy:
                 if users:
                     log.info("These users gave correct auth codes: " + ', '.join(users))
 
-                # Where is it going?
-                total_out = 0
-                dests = []
-                for idx, tx_out in psbt.output_iter():
-                    if not psbt.outputs[idx].is_change:
-                        total_out += tx_out.nValue
-                        dests.append(chain.render_address(tx_out.scriptPubKey))
-
                 # Pick a rule to apply to this specific txn
-                reasons = []
-                for rule in self.rules:
-                    try:
-                        if rule.matches_transaction(psbt, users, total_out,
-                                                        dests, local_ok):
-                            break
-                    except BaseException as exc:
-                        # let's not share these details, except for debug; since
-                        # they are not errors, just picking best rule in priority order
-                        r = "rule #%d: %s" % (rule.index, str(exc) or problem_file_line(exc))
-                        reasons.append(r)
-                        print(r)
-                else:
+                rule = self.pick_rule(psbt, users, total_out, dests, local_ok)
+                if not rule:
+                    # Nothing matched; slow path to explain why, for each rule.
+                    reasons = []
+                    for rule in self.rules:
+                        try:
+                            rule.matches_transaction(psbt, users, total_out, dests, local_ok)
+                        except BaseException as exc:
+                            # let's not share these details, except for debug; since
+                            # they are not errors, just picking best rule in priority order
+                            r = "rule #%d: %s" % (rule.index, str(exc) or problem_file_line(exc))
+                            reasons.append(r)
+                            print(r)
+
                     err = "Rejected: " + ', '.join(reasons)
                     self.refuse(log, err)
                     return 'x'
@@ -786,11 +1023,6 @@ class HSMPolicy:
 
                 # looks good, do it
                 self.approve(log, "Acceptable by rule #%d" % rule.index)
-
-                if rule.per_period is not None:
-                    self.record_spend(rule, total_out)
-
-                return 'y'
             except BaseException as exc:
                 sys.print_exception(exc)
                 err = "Rejected: " + (str(exc) or problem_file_line(exc))
@@ -798,6 +1030,14 @@ class HSMPolicy:
 
                 return 'x'
 
+        if not self.was_logged(log):
+            return 'x'
+
+        if rule.per_period is not None:
+            self.record_spend(rule, total_out)
+
+        return 'y'
+
     def refuse(self, log, msg):
         # when things fail
         log.info("\nREFUSED: " + msg)
@@ -815,13 +1055,22 @@ class HSMPolicy:
         self.approvals += 1
         self.last_refusal = None
 
+    def was_logged(self, log):
+        # Records reach the card as the AuditLogger closes. If that write
+        # failed and must_log is set, the approval just made does not stand.
+        if self.must_log and log.is_unsaved:
+            self.approvals -= 1
+            self.refuse(log, "Could not write log to card, and must_log is set")
+            return False
+
+        return True
+
 
 def hsm_status_report():
     # Return a JSON-able object. Documented and external programs
     # rely on this output... and yet, don't overshare either.
     from auth import UserAuthorizedAction
     from glob import hsm_active
-    from nvstore import settings
     from hsm_ux import ApproveHSMPolicy
 
     rv = dict()
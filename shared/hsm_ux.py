@@ -373,6 +373,7 @@ class hsmUxInteraction:
         # boottime.
         from actions import goto_top_menu
         glob.hsm_active = None
+        hsm.LogCard.release()
         goto_top_menu()
 
         # restore normal operation of UX
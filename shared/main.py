@@ -8,9 +8,11 @@
 #
 
 # see RAM_HEADER_BASE, and coldcardFirmwareHeader_t in sigheader.h
-import pyb, sys, gc, glob
+import pyb, sys, gc, glob, utime, trace
 from imptask import IMPT, die_with_debug
 
+trace.mark('main')
+
 assert not glob.dis, "main reimport"
 
 # this makes the GC run when larger objects are free in an attempt to reduce fragmentation.
@@ -24,6 +26,14 @@ if 0:
     pyb.usb_mode('VCP')
     raise SystemExit
 
+def boot_mark(label):
+    # Record progress towards the PIN prompt and first menu. Tracked by
+    # testing/test_unit.py:test_boot_profile so bloat on the boot path is noticed.
+    from utils import LAZY_MODULES
+    early = sum(1 for m in LAZY_MODULES if m in sys.modules)
+    glob.boot_profile.append((label, utime.ticks_ms(), len(sys.modules), early, gc.mem_alloc()))
+    trace.mark(label)
+
 print("---\nColdcard Wallet from Coinkite Inc. (c) 2018-2021.\n")
 
 # Setup OLED and get something onto it.
@@ -31,6 +41,7 @@ from display import Display
 dis = Display()
 dis.splash()
 glob.dis = dis
+boot_mark('display')
 
 # slowish imports, some with side-effects
 import version, ckcc, uasyncio
@@ -56,6 +67,7 @@ from sflash import SF
 
 # NV settings
 from nvstore import settings
+boot_mark('settings')
 
 async def more_setup():
     # Boot up code; splash screen is being shown
@@ -97,6 +109,7 @@ async def more_setup():
         # based on contents of secure chip (ie. is there
         # a wallet defined)
         from actions import start_login_sequence
+        boot_mark('login')
         await start_login_sequence()
     except BaseException as exc:
         die_with_debug(exc)
@@ -112,6 +125,7 @@ async def mainline():
     from ux import the_ux
 
     goto_top_menu()
+    boot_mark('menu')
 
     gc.collect()
     #print("Free mem: %d" % gc.mem_free())
@@ -43,6 +43,7 @@ freeze_as_mpy('', [
 	'sram2.py',
 	'ssd1306.py',
 	'stash.py',
+	'trace.py',
 	'usb.py',
 	'users.py',
 	'utils.py',
@@ -8,7 +8,8 @@
 # - recover from empty/blank/failed chips w/o user action
 #
 # Result:
-# - up to 4k of values supported (after json encoding)
+# - up to 4k of values supported (after json encoding), plus 4k for
+#   each of the values in NAMESPACES (multisig wallets, HSM users)
 # - encrypted and stored in SPI flash, in last 128k area
 # - AES encryption key is derived from actual wallet secret
 # - if logged out, then use fixed key instead (ie. it's public)
@@ -17,12 +18,11 @@
 # - you cannot move data between slots because AES-CTR with CTR seed based on slot #
 # - SHA check on decrypted data
 #
-import os, ujson, ustruct, ckcc, gc, ngu, aes256ctr
+import os, ujson, ustruct, ckcc, gc, ngu, aes256ctr, trace
 from uio import BytesIO
-from sffile import SFFile
 from sflash import SF
 from uhashlib import sha256
-from random import shuffle
+from random import shuffle, randbelow
 from utils import call_later_ms
 
 # Setting values:
@@ -40,7 +40,7 @@ from utils import call_later_ms
 #   axi = index of last selected address in explorer
 #   lgto = (minutes) how long to wait for Login Countdown feature [pre v4.0.2]
 #   usr = (dict) map from username to their secret, as base32
-#   ovc = (list) "outpoint value cache"; only for segwit UTXO inputs (see history.py)
+#   ovc = (list) "outpoint value cache" [pre v4.0.3, now in own flash area: see history.py]
 #   del = (int) 0=normal 1=overwrite+delete input PSBT's, rename outputs
 #   axskip = (bool) skip warning about addr explorer
 #   du = (bool) if set, disable the USB port at all times
@@ -59,6 +59,15 @@ from utils import call_later_ms
 # where in SPI Flash we work (last 128k)
 SLOTS = range((1024-128)*1024, 1024*1024, 4096)
 
+# ring of outpoint value records, just before settings (see history.py)
+HISTORY_RING = range(SLOTS.start - (64*1024), SLOTS.start, 32)
+
+# These (larger) values are kept in their own slot, apart from other settings.
+# Each is loaded when first used, and rewritten only when it changes.
+# - short name is stored in the slot, and must fit in first block, after age
+NAMESPACES = { 'multisig': 'ms', 'usr': 'usr' }
+NS_KEYS = dict((v, k) for k, v in NAMESPACES.items())
+
 # Altho seems bad to statically alloc this big block, it solves
 # concerns with heap fragmentation, and saving settings is clearly
 # core to our mission!
@@ -66,11 +75,55 @@ SLOTS = range((1024-128)*1024, 1024*1024, 4096)
 from sram2 import nvstore_buf
 _tmp = nvstore_buf
 
+# True while a commit() (of any SettingsObject) has its data in _tmp, across awaits
+_tmp_busy = False
+
+def get_tmp():
+    # The shared work buffer, or a private one if a commit() is holding that.
+    return _tmp if not _tmp_busy else bytearray(len(_tmp))
+
+def peek_age(first):
+    # Get the age of a slot from its first decrypted block, if possible
+    if first[0:8] != b'{"_age":':
+        return None
+
+    try:
+        return int(bytes(first[8:]).split(b',')[0].split(b'}')[0])
+    except ValueError:
+        return None
+
+def peek_ns(first):
+    # Get namespace of a slot from its first decrypted block (follows the age)
+    try:
+        rest = bytes(first).split(b',"_ns":"', 1)[1]
+        return rest.split(b'"')[0].decode()
+    except (IndexError, UnicodeError):
+        return None
+
+class SettingsBatch:
+    # Context manager: changes made (and saves asked for) inside are written
+    # once at the end. See SettingsObject.batch()
+
+    def __init__(self, s):
+        self.s = s
+
+    def __enter__(self):
+        self.s.batching += 1
+        return self.s
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.s.end_batch()
+
 class SettingsObject:
 
     def __init__(self, dis=None):
         self.is_dirty = 0
         self.my_pos = 0
+        self.gen = 0                # bumped by anything that changes my_pos or slots
+        self.committing = False     # background write in progress
+        self.blanks = set()         # slots seen erased, ready to write
+        self.batching = 0           # nesting depth of batch()
+        self.save_wanted = False    # save() called during batch
 
         self.nvram_key = b'\0'*32
         self.capacity = 0
@@ -79,19 +132,23 @@ class SettingsObject:
 
         self.load(dis)
 
-    def get_aes(self, pos):
+    def get_aes(self, pos, ns=False):
         # Build AES object for en/decrypt of specific block.
         # Include the slot number as part of the initial counter (CTR)
-        ctr = ustruct.pack('<4I', 4, 3, 2, pos)
+        # - namespace slots use different CTR, so they look like noise to older versions
+        ctr = ustruct.pack('<4I', 5 if ns else 4, 3, 2, pos)
         return aes256ctr.new(self.nvram_key, ctr)
 
     def set_key(self, new_secret=None):
         # System settings (not secrets) are stored in SPI Flash, encrypted with this
         # key that is derived from main wallet secret. Call this method when the secret
         # is first loaded, or changes for some reason.
+        # - key derived from the secret in the SE is remembered by pa until next
+        #   login or change there, so repeat calls don't go back to the (slow) SE
         from pincodes import pa
         from stash import blank_object
 
+        trace.mark('nv:set_key')
         key = None
         mine = False
 
@@ -99,6 +156,8 @@ class SettingsObject:
             if not pa.is_successful() or pa.is_secret_blank():
                 # simple fixed key allows us to store a few things when logged out
                 key = b'\0'*32
+            elif pa.nvram_key:
+                key = pa.nvram_key
             else:
                 # read secret and use it.
                 new_secret = pa.fetch()
@@ -119,87 +178,132 @@ class SettingsObject:
 
             if mine:
                 blank_object(new_secret)
+                pa.nvram_key = key
 
         # for restore from backup case, or when changing (created) the seed
         self.nvram_key = key
+        trace.mark('nv:set_key-done')
+
+    def reset_namespaces(self):
+        # forget what we know about the namespace slots
+        self.ns_values = {}         # decoded values, by setting key
+        self.ns_pos = {}            # slot in use, by setting key
+        self.ns_age = {}
+        self.ns_capacity = {}
+        self.ns_found = {}          # not yet decoded: candidate slots, by setting key
+        self.ns_dirty = set()
+        self.ns_inflight = set()    # being written by commit()
+        self.core_dirty = False
 
     def load(self, dis=None):
         # Search all slots for any we can read, decrypt that,
         # and pick the newest one (in unlikely case of dups)
+        trace.mark('nv:load')
+
         # reset
         self.current.clear()
         self.overrides.clear()
+        self.reset_namespaces()
         self.my_pos = 0
         self.is_dirty = 0
         self.capacity = 0
-
-        # 4k, but last 32 bytes are a SHA (itself encrypted)
-        global _tmp
-
-        buf = bytearray(4)
-        empty = 0
+        self.gen += 1
+        self.blanks.clear()
+        self.save_wanted = False
+
+        # Peek at first block of each slot. If it decrypts to start of JSON, it's
+        # probably ours, and (if saved by newer code) will start with the age.
+        # Namespace slots are only noted here, and decoded when first used.
+        buf = bytearray(32)
+        found = []
         for pos in SLOTS:
-            if dis:
-                dis.progress_bar_show((pos-SLOTS.start) / (SLOTS.stop-SLOTS.start))
-            gc.collect()
-
             SF.read(pos, buf)
             if buf[0] == buf[1] == buf[2] == buf[3] == 0xff:
                 # erased (probably)
-                empty += 1
+                self.blanks.add(pos)
                 continue
 
-            # check if first 2 bytes makes sense for JSON
+            # Try both readings: a namespace slot can decrypt to '{"' under the
+            # main record's key too (1 in 65k), and must not be lost to that.
             aes = self.get_aes(pos)
-            chk = aes.copy().cipher(b'{"')
-
-            if chk != buf[0:2]:
-                # doesn't look like JSON meant for me
+            first = aes.cipher(buf)
+            if first[0:2] == b'{"':
+                found.append((peek_age(first), pos, aes, first))
+
+            aes = self.get_aes(pos, True)
+            first = aes.cipher(buf)
+            if first[0:2] == b'{"':
+                kn = NS_KEYS.get(peek_ns(first))
+                age = peek_age(first)
+                if kn and age is not None:
+                    self.ns_found.setdefault(kn, []).append((age, pos, aes, first))
+
+        for lst in self.ns_found.values():
+            lst.sort(key=lambda c: c[0], reverse=True)
+
+        # Newest first, and stop at first one that's good: older ones are stale and
+        # can be erased based on the age seen in the first block. Those saved by
+        # older code don't show their age there, and must be fully decoded.
+        peeked = [c for c in found if c[0] is not None]
+        peeked.sort(key=lambda c: c[0], reverse=True)
+        unpeeked = [c for c in found if c[0] is None]
+
+        for n, (age, pos, aes, first) in enumerate(peeked):
+            if self.my_pos:
+                # stale data seen; clean it up.
+                #print("NV: cleanup @ %d" % pos)
+                self.erase_slot(pos)
                 continue
 
-            # probably good, read it
-            chk = sha256()
-            aes = aes.cipher
-            expect = None
-
-            with SFFile(pos, length=4096, pre_erased=True) as fd:
-                for i in range(4096/32):        
-                    b = aes(fd.read(32))
-                    if i != 127:
-                        _tmp[i*32:(i*32)+32] = b
-                        chk.update(b)
-                    else:
-                        expect = b
-
-            try:
-                # verify checksum in last 32 bytes
-                assert expect == chk.digest()
-
-                # loads() can't work from a byte array, and converting to 
-                # bytes here would copy it; better to use file emulation.
-                fd = BytesIO(_tmp)
-                d = ujson.load(fd)
-                self.capacity = fd.seek(0,1) / 4096         # .tell() is missing
-            except:
+            if dis:
+                dis.progress_bar_show(n / len(peeked))
+            gc.collect()
+
+            d, used = self.read_slot(pos, aes, first)
+            if d is None:
                 # One in 65k or so chance to come here w/ garbage decoded, so
-                # not an error.
+                # not an error. Or damaged: try next oldest.
+                continue
+
+            self.current = d
+            self.my_pos = pos
+            self.capacity = used
+            #print("NV: data @ %d w/ age=%d" % (pos, age))
+
+        for _, pos, aes, first in unpeeked:
+            gc.collect()
+
+            d, used = self.read_slot(pos, aes, first)
+            if d is None:
                 continue
 
             got_age = d.get('_age', 0)
             if got_age > self.current.get('_age', -1):
                 # likely winner
+                if self.my_pos:
+                    self.erase_slot(self.my_pos)
+
                 self.current = d
                 self.my_pos = pos
-                #print("NV: data @ %d w/ age=%d" % (pos, got_age))
+                self.capacity = used
             else:
                 # stale data seen; clean it up.
                 assert self.current['_age'] > 0
-                #print("NV: cleanup @ %d" % pos)
-                SF.sector_erase(pos)
-                SF.wait_done()
+                self.erase_slot(pos)
+
+        # Saved before namespaces existed (or crashed part way thru save): move
+        # those values out of the main record; it's rewritten at next save.
+        for kn in NAMESPACES:
+            if kn in self.current:
+                v = self.current.pop(kn)
+                self.core_dirty = True
+                if kn not in self.ns_found:
+                    self.ns_values[kn] = v
+                    self.ns_dirty.add(kn)
 
         # 4k is a large object, sigh, for us right now. cleanup
         gc.collect()
+        trace.mark('nv:loaded')
 
         # done, if we found something
         if self.my_pos:
@@ -209,32 +313,129 @@ class SettingsObject:
         self.my_pos = 0
         self.current = self.default_values()
 
-        if empty == len(SLOTS):
+        if len(self.blanks) == len(SLOTS):
             # Whole thing is blank. Bad for plausible deniability. Write 3 slots
             # with garbage. They will be wasted space until it fills.
             blks = list(SLOTS)
             shuffle(blks)
 
             for pos in blks[0:3]:
+                self.blanks.discard(pos)
                 for i in range(0, 4096, 256):
                     h = ngu.random.bytes(256)
                     SF.wait_done()
                     SF.write(pos+i, h)
 
+    def read_slot(self, pos, aes, first):
+        # Decrypt and verify rest of slot, and decode the JSON.
+        # - first 32 bytes already decrypted, and aes has advanced past them
+        # - rest of the data is read in one go, and decrypted in place
+        # - returns (None, 0) if not valid, else (values, fraction of slot used)
+        # - a commit() may be part way thru using _tmp, so can't always touch it
+        buf = get_tmp()
+        body = memoryview(buf)[32:]
+
+        buf[0:32] = first
+        SF.read(pos+32, body)
+        aes.cipher(body, body)
+
+        expect = bytearray(32)
+        SF.read(pos+len(buf), expect)
+        expect = aes.cipher(expect)
+
+        try:
+            # verify checksum in last 32 bytes
+            assert expect == sha256(buf).digest()
+
+            # loads() can't work from a byte array, and converting to 
+            # bytes here would copy it; better to use file emulation.
+            fd = BytesIO(buf)
+            d = ujson.load(fd)
+            return d, fd.seek(0,1) / 4096         # .tell() is missing
+        except:
+            return None, 0
+
+    def load_ns(self, kn):
+        # First use of a namespace value: decode newest good copy, remove others.
+        lst = self.ns_found.pop(kn, None)
+        if not lst:
+            return
+
+        gc.collect()
+
+        for _, pos, aes, first in lst:
+            d, used = self.read_slot(pos, aes, first)
+            if d is None or d.get('_ns') != NAMESPACES[kn]:
+                continue
+
+            if kn not in self.ns_pos:
+                # newest
+                self.ns_values[kn] = d.get('v')
+                self.ns_pos[kn] = pos
+                self.ns_age[kn] = d['_age']
+                self.ns_capacity[kn] = used
+            else:
+                # stale data seen; clean it up.
+                self.erase_slot(pos)
+
+        gc.collect()
+
     def get(self, kn, default=None):
         if kn in self.overrides:
             return self.overrides.get(kn)
+        elif kn in NAMESPACES:
+            self.load_ns(kn)
+            return self.ns_values.get(kn, default)
         else:
             return self.current.get(kn, default)
 
-    def changed(self):
+    def changed(self, kn=None):
+        # note a value has changed; give key if only that one
+        if kn in NAMESPACES:
+            self.ns_dirty.add(kn)
+        elif kn:
+            self.core_dirty = True
+        else:
+            # unknown what: everything we have loaded
+            self.core_dirty = True
+            self.ns_dirty.update(self.ns_values)
+
         self.is_dirty += 1
-        if self.is_dirty < 2:
+        if self.is_dirty < 2 and not self.batching:
+            call_later_ms(250, self.write_out)
+
+    def batch(self):
+        # Use as "with settings.batch():" around a flow making several changes:
+        # nothing is written until it's done. If save() was called, that
+        # happens at the end, otherwise the usual delayed write.
+        return SettingsBatch(self)
+
+    def end_batch(self):
+        self.batching -= 1
+        if self.batching:
+            return
+
+        if self.save_wanted:
+            self.save_wanted = False
+            self.save()
+        elif self.is_dirty:
             call_later_ms(250, self.write_out)
 
+    def flush(self):
+        # write anything pending right now, even if inside a batch
+        # - before logout or power down, when the delayed write would never happen
+        # - also if commit() is part way, since it will never finish
+        if self.is_dirty or self.save_wanted or self.committing:
+            self.save_wanted = False
+            self.write_now()
+
     def put(self, kn, v):
-        self.current[kn] = v
-        self.changed()
+        if kn in NAMESPACES:
+            self.load_ns(kn)        # so old copy is known, and erased later
+            self.ns_values[kn] = v
+        else:
+            self.current[kn] = v
+        self.changed(kn)
 
     def put_volatile(self, kn, v):
         self.overrides[kn] = v
@@ -242,8 +443,12 @@ class SettingsObject:
     set = put
 
     def remove_key(self, kn):
-        self.current.pop(kn, None)
-        self.changed()
+        if kn in NAMESPACES:
+            self.load_ns(kn)
+            self.ns_values.pop(kn, None)
+        else:
+            self.current.pop(kn, None)
+        self.changed(kn)
 
     def clear(self):
         # could be just:
@@ -252,32 +457,75 @@ class SettingsObject:
         rk = [k for k in self.current if k[0] != '_']
         for k in rk:
             del self.current[k]
+
+        for kn in NAMESPACES:
+            self.load_ns(kn)
+        self.ns_values.clear()
+        self.ns_dirty.update(self.ns_pos)
             
         self.overrides.clear()
         self.changed()
+
+    def capacity_of(self, kn):
+        # fraction of a slot used by a namespace value (as last read or written)
+        return self.ns_capacity.get(kn, 0)
+
+    def all_values(self):
+        # all stored values, including those in namespaces; for backups and such
+        rv = dict(self.current)
+        for kn in NAMESPACES:
+            self.load_ns(kn)
+        rv.update(self.ns_values)
+
+        return rv
         
     async def write_out(self):
         # delayed write handler
-        if not self.is_dirty:
-            # someone beat me to it
+        if not self.is_dirty or self.batching:
+            # someone beat me to it, or end of batch will reschedule
+            return
+
+        if self.committing:
+            # another write is underway, try again after
+            call_later_ms(250, self.write_out)
             return
 
         # Was sometimes running low on memory in this area: recover
         try:
             gc.collect()
-            self.save()
+            await self.commit()
         except MemoryError:
             call_later_ms(250, self.write_out)
 
-    def find_spot(self, not_here=0):
-        # search for a blank sector to use 
-        # - check randomly and pick first blank one (wear leveling, deniability)
+    def own_slots(self):
+        # all slots we know hold our data
+        rv = set(self.ns_pos.values())
+        rv.add(self.my_pos)
+        for lst in self.ns_found.values():
+            rv.update(c[1] for c in lst)
+
+        return rv
+
+    def find_spot(self):
+        # pick a blank sector to use
+        # - random choice from those we know are erased (wear leveling, deniability)
+        # - other SettingsObject's may have written there since, so check it
         # - we will write and then erase old slot
-        # - if "full", blow away a random one
-        options = [s for s in SLOTS if s != not_here]
+        # - if none known, search; if "full", blow away a random one (not ours)
+        buf = bytearray(16)
+        while self.blanks:
+            options = list(self.blanks)
+            pos = options[randbelow(len(options))]
+            self.blanks.discard(pos)
+
+            SF.read(pos, buf)
+            if set(buf) == {0xff}:
+                return pos
+
+        mine = self.own_slots()
+        options = [s for s in SLOTS if s not in mine]
         shuffle(options)
 
-        buf = bytearray(16)
         for pos in options:
             SF.read(pos, buf)
             if set(buf) == {0xff}:
@@ -294,68 +542,231 @@ class SettingsObject:
 
         return victem
 
-    def save(self):
-        # render as JSON, encrypt and write it.
+    def erase_slot(self, pos):
+        # erase a slot (that we're done with) and wait for that
+        SF.sector_erase(pos)
+        SF.wait_done()
+        self.blanks.add(pos)
+
+    async def find_spare(self):
+        # Keep one erased slot ready, so next save doesn't have to search in foreground.
+        # - blanks goes stale as other SettingsObject's use and free slots, so probe
+        # - never erase anything here: a slot that isn't ours may be the live record
+        #   of another key (pre-login settings, other wallet). If truly full,
+        #   find_spot() still handles that, as before.
+        if self.blanks or self.committing:
+            # not needed, or commit() will call us when done
+            return
 
-        self.current['_age'] = self.current.get('_age', 1) + 1
+        mine = self.own_slots()
+        options = [s for s in SLOTS if s not in mine]
+        shuffle(options)
 
-        pos = self.find_spot(self.my_pos)
+        buf = bytearray(16)
+        for pos in options:
+            SF.read(pos, buf)
+            if set(buf) == {0xff}:
+                self.blanks.add(pos)
+                return
+
+    def render(self, pos, d, ns=False, buf=None):
+        # Encrypt JSON data for the slot at pos, and yield
+        # (offset, data) for each piece to be written, page by page.
+        # - JSON data, padded w/ zeros, then SHA256 over that in last 32 bytes
+        # - whole thing is built in buf (see get_tmp) and encrypted there, in one pass
+        aes = self.get_aes(pos, ns).cipher
+        buf = memoryview(buf or get_tmp())
+        zeros = memoryview(bytes(256))
+
+        buf[0:len(d)] = d
+        for offset in range(len(d), len(buf), 256):
+            here = min(256, len(buf)-offset)
+            buf[offset:offset+here] = zeros[0:here]
+
+        chk = sha256(buf).digest()
+
+        # in-place
+        aes(buf, buf)
+        chk = aes(chk)
+
+        for offset in range(0, len(buf), 256):
+            yield offset, buf[offset:offset+256]
+
+        yield len(buf), chk
+
+    def records(self, core=True):
+        # What needs writing: list of (setting key, JSON bytes) where key
+        # is None for the main record, and JSON is None if namespace value is removed.
+        # - namespaces first, so main record is written last
+        rv = []
+        self.ns_inflight = set(self.ns_dirty)
+        for kn in self.ns_dirty:
+            if kn not in self.ns_values:
+                rv.append((kn, None))
+                continue
 
-        aes = self.get_aes(pos).cipher
+            age = self.ns_age.get(kn, 0) + 1
+            self.ns_age[kn] = age
+            d = '{"_age":%d,"_ns":"%s","v":%s}' % (age, NAMESPACES[kn],
+                                                    ujson.dumps(self.ns_values[kn]))
+            rv.append((kn, d.encode()))
 
-        with SFFile(pos, max_size=4096, pre_erased=True) as fd:
-            chk = sha256()
+        self.ns_dirty.clear()
 
-            # first the json data
-            d = ujson.dumps(self.current)
+        if core or self.core_dirty:
+            self.current['_age'] = self.current.get('_age', 1) + 1
+            rv.append((None, self.encode().encode()))
+            self.core_dirty = False
 
-            # pad w/ zeros
-            dat_len = len(d)
-            pad_len = (4096-32) - dat_len
-            assert pad_len >= 0, 'too big'
+        for kn, d in rv:
+            if d is not None:
+                assert len(d) <= (4096-32), 'too big'
 
-            self.capacity = dat_len / 4096
+        return rv
 
-            fd.write(aes(d))
-            chk.update(d)
-            del d
+    def record_done(self, kn, pos, d):
+        # record has been written at pos; note that and return old slot to be erased
+        if kn is None:
+            old, self.my_pos = self.my_pos, pos
+            self.capacity = len(d) / 4096
+        else:
+            old = self.ns_pos.pop(kn, 0)
+            if pos:
+                self.ns_pos[kn] = pos
+                self.ns_capacity[kn] = len(d) / 4096
+            else:
+                self.ns_capacity.pop(kn, None)
 
-            while pad_len > 0:
-                here = min(32, pad_len)
+        return old if old != pos else 0
 
-                pad = bytes(here)
-                fd.write(aes(pad))
-                chk.update(pad)
+    def save(self):
+        # render as JSON, encrypt and write it.
+        # - inside a batch, happens at the end of that instead
+        if self.batching:
+            self.save_wanted = True
+            return
 
-                pad_len -= here
-        
-            fd.write(aes(chk.digest()))
-            assert fd.tell() == 4096
+        self.write_now()
 
-        # erase old copy of data
-        if self.my_pos and self.my_pos != pos:
-            SF.wait_done()
-            SF.sector_erase(self.my_pos)
-            SF.wait_done()
+    def write_now(self):
+        # see save()
+        self.gen += 1
 
-        self.my_pos = pos
+        # might be interrupting commit(), which will give up; take over its work
+        self.ns_dirty.update(self.ns_inflight)
+
+        for kn, d in self.records():
+            pos = 0
+            if d is not None:
+                pos = self.find_spot()
+
+                for offset, page in self.render(pos, d, kn is not None):
+                    SF.write(pos+offset, page)
+                    SF.wait_done()
+
+            # erase old copy of data
+            old = self.record_done(kn, pos, d)
+            if old:
+                self.erase_slot(old)
+
+        self.ns_inflight = set()
         self.is_dirty = 0
 
+        if not self.blanks:
+            call_later_ms(250, self.find_spare)
+
+    async def commit(self):
+        # Same as save() but let other tasks run while the flash is busy, and
+        # only write records that have changed.
+        # - new slot is completely written (checksum last) before old one is erased,
+        #   so power loss at any point leaves a good copy
+        # - if load/save/blank happen meanwhile, they win: abandon our copy
+        # - we hold _tmp while writing a record, so others use their own buffer
+        global _tmp_busy
+        self.committing = True
+        trace.mark('nv:commit')
+        try:
+            self.gen += 1
+            gen = self.gen
+            self.is_dirty = 0
+
+            for kn, d in self.records(core=False):
+                pos = 0
+                if d is not None:
+                    pos = self.find_spot()
+
+                    buf = get_tmp()
+                    mine = (buf is _tmp)
+                    if mine:
+                        _tmp_busy = True
+
+                    try:
+                        for offset, page in self.render(pos, d, kn is not None, buf):
+                            SF.write(pos+offset, page)
+                            await self.wait_flash()
+
+                            if self.gen != gen:
+                                # partial slot isn't valid, but don't waste it
+                                SF.sector_erase(pos)
+                                await self.wait_flash()
+                                self.blanks.add(pos)
+                                return
+                    finally:
+                        if mine:
+                            _tmp_busy = False
+
+                # erase old copy of data
+                old = self.record_done(kn, pos, d)
+                if old:
+                    SF.sector_erase(old)
+                    await self.wait_flash()
+                    self.blanks.add(old)
+        finally:
+            self.committing = False
+            self.ns_inflight = set()
+            trace.mark('nv:commit-done')
+
+        await self.find_spare()
+
+    async def wait_flash(self):
+        # yield until write/erase done; keep others off the chip meanwhile
+        await SF.wait_bg()
+
+    def encode(self):
+        # JSON of current values, but with _age first, so that
+        # it can be seen after decrypting just the first block
+        age = self.current.pop('_age')
+        try:
+            d = ujson.dumps(self.current)
+        finally:
+            self.current['_age'] = age
+
+        return '{"_age":%d%s%s' % (age, ',' if len(d) > 2 else '', d[1:])
+
     def merge(self, prev):
         # take a dict of previous values and merge them into what we have
-        self.current.update(prev)
+        for kn, v in prev.items():
+            if kn in NAMESPACES:
+                self.load_ns(kn)
+                self.ns_values[kn] = v
+                self.ns_dirty.add(kn)
+            else:
+                self.current[kn] = v
 
     def blank(self):
         # erase current copy of values in nvram; older ones may exist still
         # - use when clearing the seed value
-        if self.my_pos:
-            SF.wait_done()
-            SF.sector_erase(self.my_pos)
-            self.my_pos = 0
+        for pos in self.own_slots():
+            if pos:
+                self.erase_slot(pos)
+        self.my_pos = 0
+        self.gen += 1
+        self.save_wanted = False
 
         # act blank too, just in case.
         self.current.clear()
         self.overrides.clear()
+        self.reset_namespaces()
         self.is_dirty = 0
         self.capacity = 0
 
@@ -2,7 +2,7 @@
 #
 # pincodes.py - manage PIN code (which map to wallet seeds)
 #
-import ustruct, ckcc, version
+import ustruct, ckcc, version, trace
 from ubinascii import hexlify as b2a_hex
 from callgate import enter_dfu
 from bip39 import wordlist_en
@@ -117,6 +117,7 @@ class PinAttempt:
         self.state_flags = 0            # useful readback
         self.private_state = 0          # opaque data, but preserve
         self.cached_main_pin = bytearray(32)
+        self.nvram_key = None           # settings key derived from secret; see nvstore
 
 
         assert MAX_PIN_LEN == 32        # update FMT otherwise
@@ -313,6 +314,7 @@ class PinAttempt:
         self.is_secondary = secondary
         self.pin = pin
         self.hmac = bytes(32)
+        self.nvram_key = None
 
         _ = self.roundtrip(0)
 
@@ -323,6 +325,8 @@ class PinAttempt:
 
     def login(self):
         # test we have the PIN code right, and unlock access if so.
+        trace.mark('pa:login')
+        self.nvram_key = None
         chk = self.roundtrip(2)
         self.is_empty = (chk[0] == 0)
 
@@ -334,10 +338,13 @@ class PinAttempt:
             global _word_cache
             _word_cache.clear()
 
+        trace.mark('pa:login-done')
+
         return ok
 
     def change(self, **kws):
         # change various values, stored in secure element
+        self.nvram_key = None
         self.roundtrip(3, **kws)
 
         # IMPORTANT: 
@@ -381,7 +388,7 @@ class PinAttempt:
         import stash
 
         # capture values we have already
-        old_values = dict(settings.current)
+        old_values = settings.all_values()
 
         settings.set_key(raw_secret)
         settings.load()
@@ -5,7 +5,7 @@
 from ustruct import unpack_from, unpack, pack
 from ubinascii import hexlify as b2a_hex
 from utils import xfp2str, B2A, keypath_to_str, problem_file_line
-import stash, gc, history, sys, ngu
+import stash, gc, history, sys, ngu, trace
 from uhashlib import sha256
 from uio import BytesIO
 from sffile import SizerFile
@@ -15,7 +15,7 @@ from exceptions import FatalPSBTIssue, FraudulentChangeOutput
 from serializations import ser_compact_size, deser_compact_size, hash160, hash256
 from serializations import CTxIn, CTxInWitness, CTxOut, SIGHASH_ALL, ser_uint256
 from serializations import ser_sig_der, uint256_from_str, ser_push_data, uint256_from_str
-from serializations import ser_string
+from serializations import ser_string, read_view
 from nvstore import settings
 
 from public_constants import (
@@ -98,7 +98,7 @@ def calc_txid(fd, poslen, body_poslen=None):
     # see if witness encoding in effect
     fd.seek(poslen[0])
 
-    txn_version, marker, flags = unpack("<iBB", fd.read(6))
+    txn_version, marker, flags = unpack("<iBB", read_view(fd, 6))
     has_witness = (marker == 0 and flags != 0x0)
 
     if not has_witness:
@@ -127,7 +127,7 @@ def calc_txid(fd, poslen, body_poslen=None):
     # assume last 4 bytes are the lock_time
     fd.seek(sum(poslen) - 4)
 
-    rv.update(fd.read(4))
+    rv.update(read_view(fd, 4))
 
     return ngu.hash.sha256s(rv.digest())
 
@@ -208,7 +208,7 @@ class psbtProxy:
             out_fd.write(ser_compact_size(ll))
             self.fd.seek(pos)
             while ll:
-                t = self.fd.read(min(64, ll))
+                t = read_view(self.fd, min(256, ll))
                 out_fd.write(t)
                 ll -= len(t)
 
@@ -228,6 +228,12 @@ class psbtProxy:
         self.fd.seek(pos)
         return self.fd.read(ll)
 
+    def get_view(self, val):
+        # get the value, but only valid until next read; avoids allocation
+        pos, ll = val
+        self.fd.seek(pos)
+        return read_view(self.fd, ll)
+
     def parse_subpaths(self, my_xfp):
         # Reformat self.subpaths into a more useful form for us; return # of them
         # that are ours (and track that as self.num_our_keys)
@@ -256,7 +262,7 @@ class psbtProxy:
             assert (vl//4) <= MAX_PATH_DEPTH, 'too deep'
 
             # promote to a list of ints
-            v = self.get(self.subpaths[pk])
+            v = self.get_view(self.subpaths[pk])
             here = list(unpack_from('<%dI' % (vl//4), v))
 
             # update in place
@@ -590,7 +596,7 @@ class psbtInputProxy(psbtProxy):
         # fully parsing it... pull out a single TXO
         fd.seek(self.utxo[0])
 
-        _, marker, flags = unpack("<iBB", fd.read(6))
+        _, marker, flags = unpack("<iBB", read_view(fd, 6))
         wit_format = (marker == 0 and flags != 0x0)
         if not wit_format:
             # rewind back over marker+flags
@@ -918,7 +924,7 @@ class psbtObject(psbtProxy):
         # and BIP-144 ... we expect witness serialization, but
         # don't force that
 
-        self.txn_version, marker, flags = unpack("<iBB", fd.read(6))
+        self.txn_version, marker, flags = unpack("<iBB", read_view(fd, 6))
         self.had_witness = (marker == 0 and flags != 0x0)
 
         assert self.txn_version in {1,2}, "bad txn version"
@@ -950,7 +956,7 @@ class psbtObject(psbtProxy):
             self.wit_start = _skip_n_objs(fd, num_in, 'CTxInWitness')
 
         # we are at end of outputs, and no witness data, so locktime is here
-        self.lock_time = unpack("<I", fd.read(4))[0]
+        self.lock_time = unpack("<I", read_view(fd, 4))[0]
 
         assert fd.tell() == end_pos, 'txn read end wrong'
 
@@ -1233,6 +1239,7 @@ class psbtObject(psbtProxy):
         # Look an the UTXO's that we are spending. Do we have them? Do the
         # hashes match, and what values are we getting?
         # Important: parse incoming UTXO to build total input value
+        trace.mark('psbt:inputs')
         missing = 0
         total_in = 0
 
@@ -1335,6 +1342,7 @@ class psbtObject(psbtProxy):
     @classmethod
     def read_psbt(cls, fd):
         # read in a PSBT file. Captures fd and keeps it open.
+        trace.mark('psbt:read')
         hdr = fd.read(5)
         if hdr != b'psbt\xff':
             raise ValueError("bad hdr")
@@ -1351,6 +1359,7 @@ class psbtObject(psbtProxy):
 
         rv.inputs = [psbtInputProxy(fd, idx) for idx in range(rv.num_inputs)]
         rv.outputs = [psbtOutputProxy(fd, idx) for idx in range(rv.num_outputs)]
+        trace.mark('psbt:parsed')
 
         return rv
 
@@ -1406,6 +1415,7 @@ class psbtObject(psbtProxy):
         # - update our state with new partial sigs
         from glob import dis
 
+        trace.mark('psbt:sign')
         with stash.SensitiveValues() as sv:
             # Double check the change outputs are right. This is slow, but critical because
             # it detects bad actors, not bugs or mistakes.
@@ -1542,7 +1552,7 @@ class psbtObject(psbtProxy):
 
         # done.
         dis.progress_bar_show(1)
-
+        trace.mark('psbt:signed')
 
     def make_txn_sighash(self, replace_idx, replacement, sighash_type):
         # calculate the hash value for one input of current transaction
@@ -1675,10 +1685,16 @@ class psbtObject(psbtProxy):
         # Stream out the finalized transaction, with signatures applied
         # - assumption is it's complete already.
         # - returns the TXID of resulting transaction
-        # - but in segwit case, needs to re-read to calculate it
-        # - fd must be read/write and seekable to support txid calc
+        # - txid is hashed as we go, so no need to re-read what was written
+
+        # txid covers everything but the marker/flags and witness data
+        txh = sha256()
 
-        fd.write(pack('<i', self.txn_version))           # nVersion
+        def body(b):
+            fd.write(b)
+            txh.update(b)
+
+        body(pack('<i', self.txn_version))           # nVersion
 
         # does this txn require witness data to be included?
         # - yes, if the original txn had some
@@ -1689,10 +1705,8 @@ class psbtObject(psbtProxy):
             # zero marker, and flags=0x01
             fd.write(b'\x00\x01')
 
-        body_start = fd.tell()
-
         # inputs
-        fd.write(ser_compact_size(self.num_inputs))
+        body(ser_compact_size(self.num_inputs))
         for in_idx, txi in self.input_iter():
             inp = self.inputs[in_idx]
 
@@ -1719,19 +1733,17 @@ class psbtObject(psbtProxy):
 
                 txi.scriptSig = s
 
-            fd.write(txi.serialize())
+            body(txi.serialize())
 
         # outputs
-        fd.write(ser_compact_size(self.num_outputs))
+        body(ser_compact_size(self.num_outputs))
         for out_idx, txo in self.output_iter():
-            fd.write(txo.serialize())
+            body(txo.serialize())
 
             # capture change output amounts (if segwit)
             if self.outputs[out_idx].is_change and self.outputs[out_idx].witness_script:
                 history.add_segwit_utxos(out_idx, txo.nValue)
 
-        body_end = fd.tell()
-
         if needs_witness:
             # witness values
             # - preserve any given ones, add ours
@@ -1750,15 +1762,10 @@ class psbtObject(psbtProxy):
                 fd.write(wit.serialize())
 
         # locktime
-        fd.write(pack('<I', self.lock_time))
+        body(pack('<I', self.lock_time))
 
         # calc transaction ID
-        if not needs_witness:
-            # easy w/o witness data
-            txid = ngu.hash.sha256s(fd.checksum.digest())
-        else:
-            # legacy cost here for segwit: re-read what we just wrote
-            txid = calc_txid(fd, (0, fd.tell()), (body_start, body_end-body_start))
+        txid = ngu.hash.sha256s(txh.digest())
 
         history.add_segwit_utxos_finalize(txid)
 
@@ -46,14 +46,21 @@ def ser_compact_size(l):
     else:
         return struct.pack("<BQ", 255, l)
 
+def read_view(f, n):
+    # read a few bytes, without allocating if the stream supports that (SFFile)
+    # - result only valid until next read, so copy if keeping it
+    if hasattr(f, 'read_view'):
+        return f.read_view(n)
+    return f.read(n)
+
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
+    nit = struct.unpack("<B", read_view(f, 1))[0]
     if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+        nit = struct.unpack("<H", read_view(f, 2))[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = struct.unpack("<I", read_view(f, 4))[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = struct.unpack("<Q", read_view(f, 8))[0]
     return nit
 
 def deser_string(f):
@@ -64,11 +71,9 @@ def ser_string(s):
     return ser_compact_size(len(s)) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    b = read_view(f, 32)
+    assert len(b) == 32
+    return int.from_bytes(b, 'little')
 
 
 def ser_uint256(u):
@@ -294,7 +299,7 @@ class COutPoint(object):
 
     def deserialize(self, f):
         self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        self.n = struct.unpack("<I", read_view(f, 4))[0]
 
     def serialize(self):
         r = ser_uint256(self.hash)
@@ -318,7 +323,7 @@ class CTxIn(object):
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
         self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.nSequence = struct.unpack("<I", read_view(f, 4))[0]
 
     def serialize(self):
         r = self.prevout.serialize()
@@ -338,7 +343,7 @@ class CTxOut(object):
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
+        self.nValue = struct.unpack("<q", read_view(f, 8))[0]
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
@@ -475,11 +480,11 @@ class CTransaction(object):
             self.wit = copy.deepcopy(tx.wit)
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = struct.unpack("<i", read_view(f, 4))[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = struct.unpack("<B", read_view(f, 1))[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
@@ -490,7 +495,7 @@ class CTransaction(object):
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
             self.wit.deserialize(f)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = struct.unpack("<I", read_view(f, 4))[0]
         self.sha256 = None
         self.hash = None
 
@@ -9,18 +9,41 @@
 # - the offset is the file name
 # - last 64k of memory reserved for settings
 #
-from uasyncio import sleep_ms
+from uasyncio import sleep_ms, create_task
 from uio import BytesIO
 from uhashlib import sha256
 from sflash import SF
+from utime import ticks_ms, ticks_diff
 
 # this code works on large "blocks" defined by the chip as 64k
 blksize = const(65536)
 
+# limit progress bar redraws: min time between them, and must change by a pixel
+PROGRESS_MS = const(100)
+PROGRESS_STEPS = const(128)
+
+# shared space for read_view(), contents only valid until next read
+_scratch = bytearray(256)
+
 def PADOUT(n):
     # rounds up
     return (n + blksize - 1) & ~(blksize-1)
 
+def start_erase(start, max_size):
+    # Erase a region in a background task, and return that task.
+    # - await the task before writing into the region
+    # - meanwhile, other flash access waits for each block erase to finish
+    assert start % blksize == 0 # 'misaligned'
+
+    async def doit():
+        for i in range(0, PADOUT(max_size), blksize):
+            SF.block_erase(start + i)
+
+            # expect block erase to take up to 2 seconds
+            await SF.wait_bg(50)
+
+    return create_task(doit())
+
 class SFFile:
     def __init__(self, start, length=0, max_size=None, message=None, pre_erased=False):
         if not pre_erased:
@@ -29,6 +52,7 @@ class SFFile:
         self.pos = 0
         self.length = length        # byte-wise length
         self.message = message
+        self.last_bar = None        # (when, pixels) of last progress bar update
 
         if max_size != None:
             self.max_size = PADOUT(max_size) if not pre_erased else max_size
@@ -74,13 +98,28 @@ class SFFile:
             SF.block_erase(self.start + i)
 
             if i and self.message:
-                from glob import dis
-                dis.progress_bar_show(i/self.max_size)
+                self.progress(i/self.max_size)
 
             # expect block erase to take up to 2 seconds
             while SF.is_busy():
                 await sleep_ms(50)
 
+    def progress(self, frac):
+        # Update progress bar, but not too often: each redraw sends the
+        # whole framebuffer to the display.
+        now = ticks_ms()
+        px = int(frac * PROGRESS_STEPS)
+
+        if self.last_bar:
+            when, was = self.last_bar
+            if px == was or ticks_diff(now, when) < PROGRESS_MS:
+                return
+
+        self.last_bar = (now, px)
+
+        from glob import dis
+        dis.progress_bar_show(frac)
+
     def __enter__(self):
         if self.message:
             from glob import dis
@@ -140,6 +179,14 @@ class SFFile:
         return sofar
 
     def read(self, ll=None):
+        # altho tempting to return a bytearray (or view) many callers
+        # expect return to be bytes and have those methods, like "find"
+        return bytes(self.read_view(ll))
+
+    def read_view(self, ll=None, buf=None):
+        # Read into provided buffer, or shared scratch space if it fits, and
+        # return a memoryview of the data. Only valid until next read, so
+        # callers must copy anything they want to keep.
         if ll == 0:
             return b''
         elif ll is None:
@@ -151,18 +198,18 @@ class SFFile:
             # at EOF
             return b''
 
-        rv = bytearray(ll)
+        if buf is None:
+            buf = _scratch if ll <= len(_scratch) else bytearray(ll)
+
+        rv = memoryview(buf)[0:ll]
         SF.read(self.start + self.pos, rv)
 
         self.pos += ll
 
         if self.message and ll > 1:
-            from glob import dis
-            dis.progress_bar_show(self.pos / self.length)
+            self.progress(self.pos / self.length)
 
-        # altho tempting to return a bytearray (which we already have) many
-        # callers expect return to be bytes and have those methods, like "find"
-        return bytes(rv)
+        return rv
 
     def read_into(self, b):
         # limitation: this will read past end of file, but not tell the caller
@@ -211,6 +258,9 @@ class SizerFile(SFFile):
     def read(self, ll=None):
         raise ValueError
 
+    def read_view(self, ll=None, buf=None):
+        raise ValueError
+
     def read_into(self, b):
         raise ValueError
 
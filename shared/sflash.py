@@ -10,8 +10,12 @@
 # Layout for project:
 #   - 384k PSBT incoming (MAX_TXN_LEN)
 #   - 384k PSBT outgoing (MAX_TXN_LEN)
+#   - 64k (unused)
+#   - 64k outpoint value history (see history.py)
 #   - 128k nvram settings (32 slots of 4k each)
 #
+# With dual_slots HSM policy, each PSBT area is split into two 192k halves.
+#
 # During firmware updates, entire flash, starting at zero may be used.
 #
 import machine
@@ -42,6 +46,29 @@ class SPIFlash:
         self.spi = machine.SPI(2, baudrate=8000000)
         self.cs = Pin('SF_CS', Pin.OUT)
 
+        # number of tasks with a write/erase running in the background; see wait_bg
+        self.bg_busy = 0
+
+    def wait_idle(self):
+        # chip ignores us while erasing, so if that might be happening
+        # in the background, must wait for it to finish
+        if self.bg_busy:
+            self.wait_done()
+
+    async def wait_bg(self, poll_ms=2):
+        # yield until write/erase is done; meanwhile, others wait for it in wait_idle()
+        # - a count, because several tasks may be doing this at once
+        from uasyncio import sleep_ms
+
+        self.bg_busy += 1
+        try:
+            while self.is_busy():
+                await sleep_ms(poll_ms)
+        finally:
+            # if cancelled, it's still running: others must wait until done
+            self.wait_done()
+            self.bg_busy -= 1
+
     def cmd(self, cmd, addr=None, complete=True, pad=False):
         if addr is not None:
             buf = bytes([cmd, (addr>>16) & 0xff, (addr >> 8) & 0xff, addr & 0xff])
@@ -58,12 +85,14 @@ class SPIFlash:
 
     def read(self, address, buf, cmd=CMD_FAST_READ):
         # random read (fast mode, because why wouldn't we?!)
+        self.wait_idle()
         self.cmd(cmd, address, complete=False, pad=True)
         self.spi.readinto(buf)
         self.cs.high()
 
     def write(self, address, buf):
         # 'page program', must already be erased
+        self.wait_idle()
         assert 1 <= len(buf) <= 256     #  "max 256"
         assert address & ~0xff == (address+len(buf)-1) & ~0xff      #  "page boundary"
 
@@ -94,11 +123,13 @@ class SPIFlash:
 
     def chip_erase(self):
         # can take up to 6 seconds, so poll is_busy()
+        self.wait_idle()
         self.cmd(CMD_WREN)
         self.cmd(CMD_CHIP_ERASE)
 
     def sector_erase(self, address):
         # erase 4k. 40-200ms delay; poll is_busy()
+        self.wait_idle()
         assert address % 4096 == 0      # "not sector start"
 
         self.cmd(CMD_WREN)
@@ -106,14 +137,15 @@ class SPIFlash:
 
     def block_erase(self, address):
         # erase 64k at once
+        self.wait_idle()
         assert address % 65536 == 0     # "not block start"
         self.cmd(CMD_WREN)
         self.cmd(CMD_BLK_ERASE, address)
 
     def wipe_most(self):
-        # erase everything except settings: takes 5 seconds at least
-        from nvstore import SLOTS
-        end = SLOTS[0]
+        # erase everything except settings and history: takes 5 seconds at least
+        from nvstore import HISTORY_RING
+        end = HISTORY_RING.start
 
         from glob import dis
         dis.fullscreen("Cleanup...")
@@ -10,7 +10,7 @@
 #    - 'abandon' * 17 + 'agent'
 #    - 'abandon' * 11 + 'about'
 #
-import ngu, uctypes, gc, bip39
+import ngu, uctypes, gc, bip39, trace
 from uhashlib import sha256
 from pincodes import AE_SECRET_LEN
 from utils import swab32
@@ -119,6 +119,7 @@ class SensitiveValues:
     # be a context manager, and holder to secrets in-memory
 
     def __init__(self, secret=None, bypass_pw=False):
+        trace.mark('sv:init')
         if secret is None:
             # fetch the secret from bootloader/atecc508a
             from pincodes import pa
@@ -146,6 +147,7 @@ class SensitiveValues:
         self.spots.append(self.raw)
 
         self.chain = chains.current_chain()
+        trace.mark('sv:decoded')
 
         return self
 
@@ -168,6 +170,7 @@ class SensitiveValues:
 
         # .. and some GC will help too!
         gc.collect()
+        trace.mark('sv:wiped')
 
         if exc_val:
             # An exception happened, but we've done cleanup already now, so 
@@ -0,0 +1,50 @@
+# (c) Copyright 2021 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# trace.py - Timing trace: a small ring of (tag, ticks_us) events.
+#
+# - call mark('tag') at points of interest; costs a couple of list stores, no allocation
+# - tags should be string constants, so we only hold a reference to them
+# - read back with dump(): over USB ('trce' command, devmode/simulator only)
+#   or directly in the simulator
+#
+import utime
+
+# how many events we remember; oldest are overwritten
+TRACE_SIZE = const(64)
+
+_tags = [None] * TRACE_SIZE
+_when = [0] * TRACE_SIZE
+_count = 0
+
+def mark(tag):
+    global _count
+    n = _count % TRACE_SIZE
+    _tags[n] = tag
+    _when[n] = utime.ticks_us()
+    _count += 1
+
+def clear():
+    global _count
+    _count = 0
+
+def events():
+    # list of (tag, ticks_us), oldest first
+    first = max(0, _count - TRACE_SIZE)
+    return [(_tags[n % TRACE_SIZE], _when[n % TRACE_SIZE]) for n in range(first, _count)]
+
+def dump():
+    # Text report: microseconds since first event, since previous event, and tag.
+    # Events lost to wrap-around are counted on the first line.
+    evs = events()
+    rv = ['# %d events, %d dropped' % (len(evs), _count - len(evs))]
+
+    if evs:
+        start = prev = evs[0][1]
+        for tag, when in evs:
+            rv.append('%10d %10d %s' % (utime.ticks_diff(when, start),
+                                            utime.ticks_diff(when, prev), tag))
+            prev = when
+
+    return '\n'.join(rv)
+
+# EOF
@@ -2,8 +2,8 @@
 #
 # usb.py - USB related things
 #
-import ckcc, pyb, callgate, sys, ux, ngu, stash, aes256ctr
-from uasyncio import sleep_ms, core
+import ckcc, pyb, callgate, sys, ux, ngu, stash, aes256ctr, utime, trace
+from uasyncio import sleep_ms, core, create_task, Lock
 from uhashlib import sha256
 from public_constants import MAX_MSG_LEN, MAX_TXN_LEN, MAX_BLK_LEN, MAX_UPLOAD_LEN, AFC_SCRIPT
 from public_constants import STXN_FLAGS_MASK
@@ -46,20 +46,22 @@ hid_descp = bytes([
             0xc0,              # END_COLLECTION
         ])
 
-# Only these whitelisted USB commands are allowed once we enter HSM mode.
-# NOTE: 'robo' here would allow firmware changes during HSM mode!
-HSM_WHITELIST = frozenset({
-    'logo', 'ping', 'vers',     # harmless/boring
-    'upld', 'sha2', 'dwld', 'stxn',     # up/download/sign PSBT needed
-    'mitm','ncry',              # maybe limited by policy tho
-    'smsg',                     # limited by policy
-    'blkc', 'hsts',             # report status values
-    'stok', 'smok',             # completion check: sign txn or msg
-    'xpub', 'msck',             # quick status checks
-    'p2sh', 'show',             # limited by HSM policy
-    'user',                     # auth HSM user, other user cmds not allowed
-    'gslr',                     # read storage locker; hsm mode only, limited usage
-})
+# Session tickets: let a host resume an encrypted session after reconnecting,
+# without another ECDH and MiTM signature. Tickets are opaque to the host,
+# sealed with keys that exist only in RAM for this power-up.
+TICKET_VERSION = 0x1
+TICKET_LIFETIME = 3600 * 1000       # ms
+TICKET_LEN = 16 + 8 + 32 + 16       # nonce, (counter+issued), session key, mac
+
+# Flags for USB_COMMANDS table, see end of file
+CMD_HSM_OK  = 0x01          # allowed once we enter HSM mode
+CMD_ENCRYPT = 0x02          # must be sent over encrypted link
+CMD_MK3     = 0x04          # needs larger-memory Mk3 (has_fatram)
+CMD_FAST    = 0x08          # status poll, can answer during another request
+
+# Extra flag for 'stxn' (not part of STXN_FLAGS_MASK): PSBT is in second slot,
+# only valid with dual_slots HSM policy. See auth.TXN_SLOT_LEN
+STXN_SLOT_B = 0x80
 
 
 
@@ -101,6 +103,13 @@ class USBHandler:
         # - reset at offset zero, can be read back anytime
         self.file_checksum = sha256()
 
+        # in dual-slot HSM mode, uploads are hashed per slot instead, so that
+        # a download can happen at the same time
+        self.slot_checksums = [sha256(), sha256()]
+
+        # what 'sha2' reports: whichever of the above was last used
+        self.last_checksum = self.file_checksum
+
         # handle simulator
         self.blockable = getattr(self.dev, 'pipe', self.dev)
 
@@ -109,11 +118,22 @@ class USBHandler:
         self.msg = usb_buf
         assert len(self.msg) == MAX_MSG_LEN
 
-        self.encrypted_req = False
+        # while a request is being handled, we can answer simple status
+        # requests (single packet) using this buffer
+        # - busy_skipped: discarding the rest of a multi-packet message
+        self.busy = False
+        self.busy_skipped = False
+        self.fast_buf = bytearray(64)
+        self.tx_lock = Lock()
 
         # these will be objects later
         self.encrypt = None
         self.decrypt = None
+        self.session_key = None
+
+        # session tickets: keys picked at first use, only latest ticket is valid
+        self.ticket_keys = None
+        self.ticket_counter = 0
 
     def get_packet(self):
         # read next packet (64 bytes) waiting on the wire. Unframe it and return
@@ -138,7 +158,8 @@ class USBHandler:
 
     async def usb_hid_recv(self):
         # blocks and builds up a full-length command packet in memory
-        # - calls self.handle() once complete msg on hand
+        # - starts a task to handle it once complete msg on hand
+        # - while that task runs, quick status commands are answered here
         msg_len = 0
 
         while 1:
@@ -147,6 +168,12 @@ class USBHandler:
             try:
                 here, is_last, is_encrypted = self.get_packet()
 
+                if self.busy or self.busy_skipped:
+                    # self.msg still in use by request in progress, or we
+                    # are dropping the tail of a message that arrived meanwhile
+                    await self.handle_while_busy(here, is_last, is_encrypted)
+                    continue
+
                 #print('Rx[%d]' % len(here))
                 if here:
                     lh = len(here)
@@ -172,47 +199,12 @@ class USBHandler:
                     if self.decrypt is None:
                         raise FramingError('no key')
 
-                    self.encrypted_req = True
                     self.decrypt_inplace(msg_len)
-                else:
-                    self.encrypted_req = False
-
-                # process request
-                try:
-                    # this saves memory over a simple slice (confirmed)
-                    args = memoryview(self.msg)[4:msg_len]
-                    resp = await self.handle(self.msg[0:4], args)
-                    msg_len = 0
-                except CCBusyError:
-                    # auth UX is doing something else
-                    resp = b'busy'
-                    msg_len = 0
-                except HSMDenied:
-                    resp = b'err_Not allowed in HSM mode'
-                    msg_len = 0
-                except (ValueError, AssertionError) as exc:
-                    # some limited invalid args feedback
-                    #print("USB request caused assert: ", end='')
-                    #sys.print_exception(exc)
-                    msg = str(exc)
-                    if not msg:
-                        msg = 'Assertion ' + problem_file_line(exc)
-                    resp = b'err_' + msg.encode()[0:80]
-                    msg_len = 0
-                except MemoryError:
-                    # prefer to catch at higher layers, but sometimes can't
-                    resp = b'err_Out of RAM'
-                    msg_len = 0
-                except Exception as exc:
-                    # catch bugs and fuzzing too
-                    if is_simulator() or is_devmode:
-                        print("USB request caused this: ", end='')
-                        sys.print_exception(exc)
-                    resp = b'err_Confused ' + problem_file_line(exc)
-                    msg_len = 0
 
-                # aways send a reply if they get this far
-                await self.send_response(resp)
+                # process request, in own task so we can keep listening
+                self.busy = True
+                create_task(self.process(msg_len, is_encrypted))
+                msg_len = 0
 
             except FramingError as exc:
                 reason = exc.args[0]
@@ -226,22 +218,124 @@ class USBHandler:
                 #sys.print_exception(exc)
                 msg_len = 0
 
+    async def process(self, msg_len, is_encrypted):
+        # handle request held in self.msg, and always send a reply
+        try:
+            # this saves memory over a simple slice (confirmed)
+            args = memoryview(self.msg)[4:msg_len]
+            resp = await self.handle_safely(self.msg[0:4], args, is_encrypted)
+
+            await self.send_response(resp, is_encrypted)
+        except FramingError as exc:
+            # same reply as from receive loop; not between packets of another response
+            async with self.tx_lock:
+                self.framing_error(exc.args[0])
+        finally:
+            self.busy = False
+
+    async def handle_while_busy(self, here, is_last, is_encrypted):
+        # Another request is being handled. We can answer a few status
+        # commands (CMD_FAST), if they fit in one packet. Others get 'busy'.
+        # - the completion checks (stok/smok/bkok/pwok) do change state: when
+        #   they hand over a result they drop the finished UserAuthorizedAction.
+        #   That is sync code, touches only active_request and never self.msg
+        #   or flash, so it cannot disturb the request in progress. The host
+        #   needs this: it collects one result while sending the next PSBT.
+        # - message spanning several packets is discarded, up to its last
+        #   packet, even if the request in progress finishes meanwhile
+        if not here:
+            # zero-length packet: host is resyncing, never answer those
+            self.busy_skipped = False
+            return
+
+        ll = len(here)
+        self.fast_buf[0:ll] = here
+        here = memoryview(self.fast_buf)[0:ll]
+
+        if is_encrypted:
+            if self.decrypt is None:
+                raise FramingError('no key')
+
+            # must decrypt everything, to keep in sync with the host
+            self.decrypt(here, here)
+
+        if not is_last:
+            # part of a longer message which we will not handle
+            self.busy_skipped = True
+            return
+
+        if self.busy_skipped or len(here) < 4:
+            self.busy_skipped = False
+            resp = b'busy'
+        else:
+            cmd = bytes(here[0:4])
+            try:
+                flags = USB_COMMANDS[cmd.decode()][1]
+            except:
+                flags = 0
+
+            if flags & CMD_FAST:
+                resp = await self.handle_safely(cmd, here[4:], is_encrypted)
+            else:
+                resp = b'busy'
+
+        await self.send_response(resp, is_encrypted)
+
+    async def handle_safely(self, cmd, args, is_encrypted):
+        # dispatch, and convert errors into response
+        try:
+            return await self.handle(cmd, args, is_encrypted)
+        except FramingError:
+            # caller sends the framing error reply
+            raise
+        except CCBusyError:
+            # auth UX is doing something else
+            return b'busy'
+        except HSMDenied:
+            return b'err_Not allowed in HSM mode'
+        except (ValueError, AssertionError) as exc:
+            # some limited invalid args feedback
+            #print("USB request caused assert: ", end='')
+            #sys.print_exception(exc)
+            msg = str(exc)
+            if not msg:
+                msg = 'Assertion ' + problem_file_line(exc)
+            return b'err_' + msg.encode()[0:80]
+        except MemoryError:
+            # prefer to catch at higher layers, but sometimes can't
+            return b'err_Out of RAM'
+        except Exception as exc:
+            # catch bugs and fuzzing too
+            if is_simulator() or is_devmode:
+                print("USB request caused this: ", end='')
+                sys.print_exception(exc)
+            return b'err_Confused ' + problem_file_line(exc)
+
     def decrypt_inplace(self, msg_len):
         # self.msg is encrypted. decode it in place
-        # - seems dangerous to use memview here, but works
-        # - some memory alloc still happens here tho
-        self.msg[0:msg_len] = self.decrypt(memoryview(self.msg)[0:msg_len])
+        # - cipher writes directly into the same buffer, no alloc
+        mv = memoryview(self.msg)[0:msg_len]
+        self.decrypt(mv, mv)
 
     def encrypt_response(self, msg):
         # encrypt what we'll send to desktop
+        # - our own bytearrays (ie. from dwld) can be done in place
+
+        if isinstance(msg, bytearray):
+            return self.encrypt(msg, msg)
 
         return self.encrypt(msg)
 
-    async def send_response(self, resp):
+    async def send_response(self, resp, is_encrypted):
         # send a python object as the response
         # - we know how to encode a few things, or send binary
         # - sadly we cannot stream here because we cannot subclass streams
         # - cannot reuse rx buffer either!
+        # - only one response at a time, and encrypted in the order sent
+        async with self.tx_lock:
+            await self._send_response(resp, is_encrypted)
+
+    async def _send_response(self, resp, is_encrypted):
 
         # handle simple types here
 
@@ -260,7 +354,7 @@ class USBHandler:
 
         msg = bytearray(64)
 
-        if self.encrypt and self.encrypted_req:
+        if self.encrypt and is_encrypted:
             resp = self.encrypt_response(resp)
             final_flag = 0x80 | 0x40
         else:
@@ -296,7 +390,7 @@ class USBHandler:
         self.dev.send(b'%cfram%-59s' % (4+len(why), why))
 
 
-    async def handle(self, cmd, args):
+    async def handle(self, cmd, args, is_encrypted):
         # Dispatch incoming message, and provide reply.
         from glob import hsm_active
 
@@ -313,281 +407,317 @@ class USBHandler:
             except: 
                 pass
 
+        try:
+            fcn, flags, fmt = USB_COMMANDS[cmd]
+        except KeyError:
+            fcn = flags = None
+
         if hsm_active:
             # only a few commands are allowed during HSM mode
-            if cmd not in HSM_WHITELIST:
+            # NOTE: 'robo' must not be allowed, would permit firmware changes!
+            if not (flags and (flags & CMD_HSM_OK)):
                 raise HSMDenied
 
-        if cmd == 'dfu_':
-            # only useful in factory, undocumented.
-            return self.call_after(callgate.enter_dfu)
+        if not fcn or ((flags & CMD_MK3) and not has_fatram):
+            #print("USB garbage: %s +[%d]" % (cmd, len(args)))
+            return b'err_Unknown cmd'
 
-        if cmd == 'rebo':
-            import machine
-            return self.call_after(machine.reset)
+        if flags & CMD_ENCRYPT:
+            assert is_encrypted, 'must encrypt'
 
-        if cmd == 'logo':
-            from utils import clean_shutdown
-            return self.call_after(clean_shutdown)
+        if fmt:
+            return await fcn(self, args, *unpack_from(fmt, args))
 
-        if cmd == 'ping':
-            return b'biny' + args
+        return await fcn(self, args)
 
-        if cmd == 'upld':
-            offset, total_size = unpack_from('<II', args)
-            data = memoryview(args)[4+4:]
+    async def cmd_dfu_(self, args):
+        # only useful in factory, undocumented.
+        return self.call_after(callgate.enter_dfu)
 
-            return await self.handle_upload(offset, total_size, data)
+    async def cmd_rebo(self, args):
+        import machine
+        return self.call_after(machine.reset)
 
-        if cmd == 'dwld':
-            offset, length, fileno = unpack_from('<III', args)
-            return await self.handle_download(offset, length, fileno)
+    async def cmd_logo(self, args):
+        from utils import clean_shutdown
+        return self.call_after(clean_shutdown)
 
-        if cmd == 'ncry':
-            version, his_pubkey = unpack_from('<I64s', args)
+    async def cmd_ping(self, args):
+        return b'biny' + args
 
-            return self.handle_crypto_setup(version, his_pubkey)
+    async def cmd_upld(self, args, offset, total_size):
+        data = memoryview(args)[4+4:]
+        return await self.handle_upload(offset, total_size, data)
 
-        if cmd == 'vers':
-            from version import get_mpy_version, hw_label
-            from callgate import get_bl_version
+    async def cmd_dwld(self, args, offset, length, fileno):
+        return await self.handle_download(offset, length, fileno)
 
-            # Returning: date, version(human), bootloader version, full date version
-            # BUT: be ready for additions!
-            rv = list(get_mpy_version())
-            rv.insert(2, get_bl_version()[0])
-            rv.append(hw_label)
+    async def cmd_ncry(self, args, version, his_pubkey):
+        return self.handle_crypto_setup(version, his_pubkey)
 
-            return b'asci' + ('\n'.join(rv)).encode()
+    async def cmd_tckt(self, args):
+        # issue a ticket for the current session key
+        return b'biny' + self.issue_ticket()
 
-        if cmd == 'sha2':
-            return b'biny' + self.file_checksum.digest()
+    async def cmd_rsum(self, args, version, his_nonce):
+        return self.handle_resume(version, his_nonce, args[4+32:])
 
-        if cmd == 'xpub':
-            assert self.encrypted_req, 'must encrypt'
-            return self.handle_xpub(args)
+    async def cmd_vers(self, args):
+        from version import get_mpy_version, hw_label
+        from callgate import get_bl_version
 
-        if cmd == 'mitm':
-            assert self.encrypted_req, 'must encrypt'
-            return await self.handle_mitm_check()
+        # Returning: date, version(human), bootloader version, full date version
+        # BUT: be ready for additions!
+        rv = list(get_mpy_version())
+        rv.insert(2, get_bl_version()[0])
+        rv.append(hw_label)
 
-        if cmd == 'smsg':
-            # sign message
-            addr_fmt, len_subpath, len_msg = unpack_from('<III', args)
-            subpath = args[12:12+len_subpath]
-            msg = args[12+len_subpath:]
-            assert len(msg) == len_msg, "badlen"
+        return b'asci' + ('\n'.join(rv)).encode()
 
-            from auth import sign_msg
-            sign_msg(msg, subpath, addr_fmt)
-            return None
+    async def cmd_sha2(self, args):
+        return b'biny' + self.last_checksum.digest()
 
-        if cmd == 'p2sh':
-            # show P2SH (probably multisig) address on screen (also provides it back)
-            # - must provide redeem script, and list of [xfp+path]
-            from auth import start_show_p2sh_address
+    async def cmd_trce(self, args):
+        # timing trace, see trace.py: for developers only
+        # - arg 'c' clears it after reading, so next one shows just new events
+        assert is_simulator() or is_devmode, 'devmode'
+        rv = b'asci' + trace.dump().encode()
+        if args[0:1] == b'c':
+            trace.clear()
+        return rv
 
-            if hsm_active and not hsm_active.approve_address_share(is_p2sh=True):
-                raise HSMDenied
+    async def cmd_xpub(self, args):
+        return self.handle_xpub(args)
 
-            # new multsig goodness, needs mapping from xfp->path and M values
-            addr_fmt, M, N, script_len = unpack_from('<IBBH', args)
+    async def cmd_mitm(self, args):
+        return await self.handle_mitm_check()
 
-            assert addr_fmt & AFC_SCRIPT
-            assert 1 <= M <= N <= 20
-            assert 30 <= script_len <= 520
+    async def cmd_smsg(self, args, addr_fmt, len_subpath, len_msg):
+        # sign message
+        subpath = args[12:12+len_subpath]
+        msg = args[12+len_subpath:]
+        assert len(msg) == len_msg, "badlen"
 
-            offset = 8
-            witdeem_script = args[offset:offset+script_len]
-            offset += script_len
+        from auth import sign_msg
+        sign_msg(msg, subpath, addr_fmt)
+        return None
 
-            assert len(witdeem_script) == script_len
+    async def cmd_p2sh(self, args, addr_fmt, M, N, script_len):
+        # show P2SH (probably multisig) address on screen (also provides it back)
+        # - must provide redeem script, and list of [xfp+path]
+        from auth import start_show_p2sh_address
+        from glob import hsm_active
 
-            xfp_paths = []
-            for i in range(N):
-                ln = args[offset]
-                assert 1 <= ln <= 16, 'badlen'
-                xfp_paths.append(unpack_from('<%dI' % ln, args, offset+1))
-                offset += (ln*4) + 1
+        if hsm_active and not hsm_active.approve_address_share(is_p2sh=True):
+            raise HSMDenied
 
-            assert offset == len(args)
+        # new multsig goodness, needs mapping from xfp->path and M values
 
-            return b'asci' + start_show_p2sh_address(M, N, addr_fmt, xfp_paths,
-                                                        witdeem_script)
+        assert addr_fmt & AFC_SCRIPT
+        assert 1 <= M <= N <= 20
+        assert 30 <= script_len <= 520
 
-        if cmd == 'show':
-            # simple cases, older code: text subpath
-            from auth import start_show_address
+        offset = 8
+        witdeem_script = args[offset:offset+script_len]
+        offset += script_len
 
-            addr_fmt, = unpack_from('<I', args)
-            assert not (addr_fmt & AFC_SCRIPT)
+        assert len(witdeem_script) == script_len
 
-            return b'asci' + start_show_address(addr_fmt, subpath=args[4:])
+        xfp_paths = []
+        for i in range(N):
+            ln = args[offset]
+            assert 1 <= ln <= 16, 'badlen'
+            xfp_paths.append(unpack_from('<%dI' % ln, args, offset+1))
+            offset += (ln*4) + 1
 
-        if cmd == 'enrl':
-            # Enroll new xpubkey to be involved in multisigs.
-            # - text config file must already be uploaded
+        assert offset == len(args)
 
-            file_len, file_sha = unpack_from('<I32s', args)
-            if file_sha != self.file_checksum.digest():
-                return b'err_Checksum'
-            assert 100 < file_len <= (20*200), "badlen"
+        return b'asci' + start_show_p2sh_address(M, N, addr_fmt, xfp_paths,
+                                                    witdeem_script)
 
-            # Start an UX interaction, return immediately here
-            from auth import maybe_enroll_xpub
-            maybe_enroll_xpub(sf_len=file_len, ux_reset=True)
+    async def cmd_show(self, args, addr_fmt):
+        # simple cases, older code: text subpath
+        from auth import start_show_address
 
-            return None
+        assert not (addr_fmt & AFC_SCRIPT)
 
-        if cmd == 'msck':
-            # Quick check to test if we have a wallet already installed.
-            from multisig import MultisigWallet
-            M, N, xfp_xor = unpack_from('<3I', args)
+        return b'asci' + start_show_address(addr_fmt, subpath=args[4:])
 
-            return int(MultisigWallet.quick_check(M, N, xfp_xor))
+    async def cmd_enrl(self, args, file_len, file_sha):
+        # Enroll new xpubkey to be involved in multisigs.
+        # - text config file must already be uploaded
 
-        if cmd == 'stxn':
-            # sign transaction
-            txn_len, flags, txn_sha = unpack_from('<II32s', args)
-            if txn_sha != self.file_checksum.digest():
-                return b'err_Checksum'
+        if file_sha != self.file_checksum.digest():
+            return b'err_Checksum'
+        assert 100 < file_len <= (20*200), "badlen"
+
+        # Start an UX interaction, return immediately here
+        from auth import maybe_enroll_xpub
+        maybe_enroll_xpub(sf_len=file_len, ux_reset=True)
+
+        return None
+
+    async def cmd_msck(self, args, M, N, xfp_xor):
+        # Quick check to test if we have a wallet already installed.
+        from multisig import MultisigWallet
 
-            assert 50 < txn_len <= MAX_TXN_LEN, "badlen"
+        return int(MultisigWallet.quick_check(M, N, xfp_xor))
 
-            from auth import sign_transaction
-            sign_transaction(txn_len, (flags & STXN_FLAGS_MASK), txn_sha)
+    async def cmd_stxn(self, args, txn_len, flags, txn_sha):
+        # sign transaction
+        from auth import sign_transaction, TXN_SLOT_LEN
+
+        slot = self.upload_slot(TXN_SLOT_LEN if (flags & STXN_SLOT_B) else 0)
+
+        if slot is None:
+            assert not (flags & STXN_SLOT_B), 'slots'
+            chk = self.file_checksum
+            max_len = MAX_TXN_LEN
+        else:
+            chk = self.slot_checksums[slot]
+            max_len = TXN_SLOT_LEN
+
+        if txn_sha != chk.digest():
+            return b'err_Checksum'
+
+        assert 50 < txn_len <= max_len, "badlen"
+
+        trace.mark('usb:stxn')
+        sign_transaction(txn_len, (flags & STXN_FLAGS_MASK), txn_sha, slot=slot)
+        return None
+
+    async def cmd_stok(self, args, cmd='stok'):
+        # Have we finished (whatever) the transaction,
+        # which needed user approval? If so, provide result.
+        from auth import UserAuthorizedAction
+
+        req = UserAuthorizedAction.active_request
+        if not req:
+            return b'err_No active request'
+
+        if req.refused:
+            UserAuthorizedAction.cleanup()
+            return b'refu'
+
+        if req.failed:
+            rv = b'err_' + req.failed.encode()
+            UserAuthorizedAction.cleanup()
+            return rv
+
+        if not req.result:
+            # STILL waiting on user
             return None
 
-        if cmd == 'stok' or cmd == 'bkok' or cmd == 'smok' or cmd == 'pwok':
-            # Have we finished (whatever) the transaction,
-            # which needed user approval? If so, provide result.
-            from auth import UserAuthorizedAction
-
-            req = UserAuthorizedAction.active_request
-            if not req:
-                return b'err_No active request'
-
-            if req.refused:
-                UserAuthorizedAction.cleanup()
-                return b'refu'
-
-            if req.failed:
-                rv = b'err_' + req.failed.encode()
-                UserAuthorizedAction.cleanup()
-                return rv
-
-            if not req.result:
-                # STILL waiting on user
-                return None
-
-
-            if cmd == 'pwok':
-                # return new root xpub
-                xpub = req.result
-                UserAuthorizedAction.cleanup()
-                return b'asci' + bytes(xpub, 'ascii')
-            elif cmd == 'smok':
-                # signed message done: just give them the signature
-                addr, sig = req.address, req.result
-                UserAuthorizedAction.cleanup()
-                return pack('<4sI', 'smrx', len(addr)) + addr.encode() + sig
-            else:
-                # generic file response
-                resp_len, sha = req.result
-                UserAuthorizedAction.cleanup()
-                return pack('<4sI32s', 'strx', resp_len, sha)
-
-        if cmd == 'pass':
-            # bip39 passphrase provided, maybe use it if authorized
-            assert self.encrypted_req, 'must encrypt'
-            from auth import start_bip39_passphrase
-
-            assert settings.get('words', True), 'no seed'
-            assert len(args) < 400, 'too long'
-            pw = str(args, 'utf8')
-            assert len(pw) < 100, 'too long'
-
-            return start_bip39_passphrase(pw)
-
-        if cmd == 'back':
-            # start backup: asks user, takes long time.
-            from auth import start_remote_backup
-            return start_remote_backup()
-
-        if cmd == 'blkc':
-            # report which blockchain we are configured for
-            from chains import current_chain
-            chain = current_chain()
-            return b'asci' + chain.ctype
-
-        if cmd == 'bagi':
-            return self.handle_bag_number(args)
-
-        if has_fatram:
-            # HSM and user-related features only supported on larger-memory Mk3
-
-            if cmd == 'hsms':
-                # HSM mode "start" -- requires user approval
-                if args:
-                    file_len, file_sha = unpack_from('<I32s', args)
-                    if file_sha != self.file_checksum.digest():
-                        return b'err_Checksum'
-                    assert 2 <= file_len <= (200*1000), "badlen"
-                else:
-                    file_len = 0
+        trace.mark('usb:result')
+
+        if cmd == 'pwok':
+            # return new root xpub
+            xpub = req.result
+            UserAuthorizedAction.cleanup()
+            return b'asci' + bytes(xpub, 'ascii')
+        elif cmd == 'smok':
+            # signed message done: just give them the signature
+            addr, sig = req.address, req.result
+            UserAuthorizedAction.cleanup()
+            return pack('<4sI', 'smrx', len(addr)) + addr.encode() + sig
+        else:
+            # generic file response
+            resp_len, sha = req.result
+            UserAuthorizedAction.cleanup()
+            return pack('<4sI32s', 'strx', resp_len, sha)
 
-                # Start an UX interaction but return (mostly) immediately here
-                from hsm_ux import start_hsm_approval
-                await start_hsm_approval(sf_len=file_len, usb_mode=True)
+    async def cmd_smok(self, args):
+        return await self.cmd_stok(args, 'smok')
 
-                return None
+    async def cmd_pwok(self, args):
+        return await self.cmd_stok(args, 'pwok')
 
-            if cmd == 'hsts':
-                # can always query HSM mode
-                from hsm import hsm_status_report
-                import ujson
-                return b'asci' + ujson.dumps(hsm_status_report())
+    async def cmd_pass(self, args):
+        # bip39 passphrase provided, maybe use it if authorized
+        from auth import start_bip39_passphrase
 
-            if cmd == 'gslr':
-                # get the value held in the Storage Locker
-                assert hsm_active, 'need hsm'
-                return b'biny' + hsm_active.fetch_storage_locker()
+        assert settings.get('words', True), 'no seed'
+        assert len(args) < 400, 'too long'
+        pw = str(args, 'utf8')
+        assert len(pw) < 100, 'too long'
 
+        return start_bip39_passphrase(pw)
 
-            # User Mgmt
-            if cmd == 'nwur':     # new user
-                from users import Users
-                auth_mode, ul, sl = unpack_from('<BBB', args)
-                username = bytes(args[3:3+ul]).decode('ascii')
-                secret = bytes(args[3+ul:3+ul+sl])
+    async def cmd_back(self, args):
+        # start backup: asks user, takes long time.
+        from auth import start_remote_backup
+        return start_remote_backup()
 
-                return b'asci' + Users.create(username, auth_mode, secret).encode('ascii')
+    async def cmd_blkc(self, args):
+        # report which blockchain we are configured for
+        from chains import current_chain
+        chain = current_chain()
+        return b'asci' + chain.ctype
 
-            if cmd == 'rmur':     # delete user
-                from users import Users
-                ul, = unpack_from('<B', args)
-                username = bytes(args[1:1+ul]).decode('ascii')
+    async def cmd_bagi(self, args):
+        return self.handle_bag_number(args)
 
-                return Users.delete(username)
+    # HSM and user-related features only supported on larger-memory Mk3
 
-            if cmd == 'user':       # auth user (HSM mode)
-                from users import Users
-                totp_time, ul, tl = unpack_from('<IBB', args)
-                username = bytes(args[6:6+ul]).decode('ascii')
-                token = bytes(args[6+ul:6+ul+tl])
+    async def cmd_hsms(self, args):
+        # HSM mode "start" -- requires user approval
+        if args:
+            file_len, file_sha = unpack_from('<I32s', args)
+            if file_sha != self.file_checksum.digest():
+                return b'err_Checksum'
+            assert 2 <= file_len <= (200*1000), "badlen"
+        else:
+            file_len = 0
 
-                if hsm_active:
-                    # just queues these details, can't be checked until PSBT on-hand
-                    hsm_active.usb_auth_user(username, token, totp_time)
-                    return None
-                else:
-                    # dryrun/testing purposes: validate only, doesn't unlock nothing
-                    return b'asci' + Users.auth_okay(username, token, totp_time).encode('ascii')
+        # Start an UX interaction but return (mostly) immediately here
+        from hsm_ux import start_hsm_approval
+        await start_hsm_approval(sf_len=file_len, usb_mode=True)
+
+        return None
+
+    async def cmd_hsts(self, args):
+        # can always query HSM mode
+        from hsm import hsm_status_report
+        import ujson
+        return b'asci' + ujson.dumps(hsm_status_report())
+
+    async def cmd_gslr(self, args):
+        # get the value held in the Storage Locker
+        from glob import hsm_active
+        assert hsm_active, 'need hsm'
+        return b'biny' + hsm_active.fetch_storage_locker()
 
-        #print("USB garbage: %s +[%d]" % (cmd, len(args)))
+    # User Mgmt
 
-        return b'err_Unknown cmd'
+    async def cmd_nwur(self, args, auth_mode, ul, sl):
+        # new user
+        from users import Users
+        username = bytes(args[3:3+ul]).decode('ascii')
+        secret = bytes(args[3+ul:3+ul+sl])
 
+        return b'asci' + Users.create(username, auth_mode, secret).encode('ascii')
+
+    async def cmd_rmur(self, args, ul):
+        # delete user
+        from users import Users
+        username = bytes(args[1:1+ul]).decode('ascii')
+
+        return Users.delete(username)
+
+    async def cmd_user(self, args, totp_time, ul, tl):
+        # auth user (HSM mode)
+        from users import Users
+        from glob import hsm_active
+        username = bytes(args[6:6+ul]).decode('ascii')
+        token = bytes(args[6+ul:6+ul+tl])
+
+        if hsm_active:
+            # just queues these details, can't be checked until PSBT on-hand
+            hsm_active.usb_auth_user(username, token, totp_time)
+            return None
+        else:
+            # dryrun/testing purposes: validate only, doesn't unlock nothing
+            return b'asci' + Users.auth_okay(username, token, totp_time).encode('ascii')
 
     def call_after(self, func, *args):
         # we want to provide nice response before dying
@@ -611,17 +741,69 @@ class USBHandler:
 
         #print("session = " + str(b2a_hex(self.session_key)))
 
+        self.start_session()
+
+        xfp = settings.get('xfp', 0)
+        xpub = settings.get('xpub', '')
+
+        #assert my_pubkey[0] == 0x04
+        return b'mypb' + my_pubkey[1:] + pack('<II', xfp, len(xpub)) +  xpub
+
+    def start_session(self):
         # Would be nice to have nonce in addition to the counter, but
         # harder on the desktop side.
         ctr = aes256ctr.new(self.session_key)
         self.encrypt = ctr.cipher
         self.decrypt = ctr.copy().cipher
 
-        xfp = settings.get('xfp', 0)
-        xpub = settings.get('xpub', '')
+    def issue_ticket(self):
+        # Seal the current session key into a blob the host can give back later.
+        # - a new ticket invalidates all previous ones
+        assert self.session_key, 'no session'
 
-        #assert my_pubkey[0] == 0x04
-        return b'mypb' + my_pubkey[1:] + pack('<II', xfp, len(xpub)) +  xpub
+        if not self.ticket_keys:
+            self.ticket_keys = ngu.random.bytes(64)
+
+        self.ticket_counter += 1
+
+        nonce = ngu.random.bytes(16)
+        body = pack('<II', self.ticket_counter, utime.ticks_ms()) + self.session_key
+        body = aes256ctr.new(self.ticket_keys[0:32], nonce).cipher(body)
+
+        rv = nonce + body
+        rv += ngu.hmac.hmac_sha256(self.ticket_keys[32:], rv)[0:16]
+        assert len(rv) == TICKET_LEN
+
+        return rv
+
+    def handle_resume(self, version, his_nonce, ticket):
+        # Restart encryption using a ticket from an earlier session.
+        # - new session key is derived from old one and fresh nonces from both
+        #   sides, so the CTR keystream is never reused
+        assert version == TICKET_VERSION
+        assert len(ticket) == TICKET_LEN, 'badlen'
+
+        keys = self.ticket_keys
+        assert keys, 'no ticket'
+
+        ticket = bytes(ticket)
+        mac = ngu.hmac.hmac_sha256(keys[32:], ticket[0:-16])[0:16]
+        assert mac == ticket[-16:], 'bad ticket'
+
+        body = aes256ctr.new(keys[0:32], ticket[0:16]).cipher(ticket[16:-16])
+        counter, issued = unpack_from('<II', body)
+
+        assert counter == self.ticket_counter, 'stale ticket'
+        age = utime.ticks_diff(utime.ticks_ms(), issued & 0x3fffffff)
+        assert 0 <= age < TICKET_LIFETIME, 'expired'
+
+        my_nonce = ngu.random.bytes(32)
+        self.session_key = ngu.hmac.hmac_sha256(bytes(body[8:]),
+                                        b'resume' + his_nonce + my_nonce)
+        self.start_session()
+
+        # reply (in the clear) with our nonce and a replacement ticket
+        return b'biny' + my_nonce + self.issue_ticket()
 
     async def handle_mitm_check(self):
         # Sign the current session key using our master (bitcoin) key.
@@ -645,6 +827,7 @@ class USBHandler:
         # let them read from where we store the signed txn
         # - filenumber can be 0 or 1: uploaded txn, or result
         from sflash import SF
+        from auth import TXN_SLOT_LEN
 
         # limiting memory use here, should be MAX_BLK_LEN really
         length = min(length, MAX_BLK_LEN)
@@ -654,7 +837,8 @@ class USBHandler:
         assert 1 <= length, 'len'
 
         # maintain a running SHA256 over what's sent
-        if offset == 0:
+        # - in dual-slot mode, restarts at start of each slot
+        if offset == 0 or (offset == TXN_SLOT_LEN and self.upload_slot(offset)):
             self.file_checksum = sha256()
 
         pos = (MAX_TXN_LEN * file_number) + offset
@@ -664,6 +848,7 @@ class USBHandler:
         SF.read(pos, memoryview(resp)[4:])
 
         self.file_checksum.update(memoryview(resp)[4:])
+        self.last_checksum = self.file_checksum
 
         return resp
 
@@ -672,43 +857,64 @@ class USBHandler:
         from glob import dis, hsm_active
         from utils import check_firmware_hdr
         from sigheader import FW_HEADER_OFFSET, FW_HEADER_SIZE
-
-        # maintain a running SHA256 over what's received
-        if offset == 0:
-            self.file_checksum = sha256()
+        from auth import TXN_SLOT_LEN
 
         assert offset % 256 == 0, 'alignment'
-        assert offset+len(data) <= total_size <= MAX_UPLOAD_LEN, 'long'
+
+        slot = self.upload_slot(offset)
+        if slot is None:
+            # maintain a running SHA256 over what's received
+            if offset == 0:
+                self.file_checksum = sha256()
+            chk = self.file_checksum
+            start = 0
+        else:
+            # offset is absolute, but total_size is relative to start of slot
+            start = slot * TXN_SLOT_LEN
+            assert total_size <= TXN_SLOT_LEN, 'slot'
+            self.check_slot_idle(start)
+
+            if offset == start:
+                self.slot_checksums[slot] = sha256()
+            chk = self.slot_checksums[slot]
+
+        self.last_checksum = chk
+
+        if offset == start:
+            trace.mark('usb:upload')
+
+        end = offset - start + len(data)
+        assert end <= total_size <= MAX_UPLOAD_LEN, 'long'
 
         if hsm_active:
             # additional restrictions in HSM mode
-            assert offset+len(data) <= total_size <= MAX_TXN_LEN, 'psbt'
-            if offset == 0:
+            assert end <= total_size <= MAX_TXN_LEN, 'psbt'
+            if offset == start:
                 assert data[0:5] == b'psbt\xff', 'psbt'
 
         for pos in range(offset, offset+len(data), 256):
             if pos % 4096 == 0:
                 # erase here
-                dis.fullscreen("Receiving...", offset/total_size)
+                dis.fullscreen("Receiving...", (offset-start)/total_size)
 
                 SF.sector_erase(pos)
 
                 # expect 10-22 ms delay here
-                await sleep_ms(12)
-                while SF.is_busy():
-                    await sleep_ms(2)
+                # - in dual-slot mode, signing may be reading the other
+                #   slot meanwhile; it must wait for us
+                await SF.wait_bg()
 
             # write up to 256 bytes
             here = data[pos-offset:pos-offset+256]
 
-            self.file_checksum.update(here)
+            chk.update(here)
 
             # Very special case for firmware upgrades: intercept and modify
             # header contents on the fly, and also fail faster if wouldn't work
             # on this specific hardware.
             # - workaround: ckcc-protocol upgrade process understates the file
             #   length and appends hdr, but that's kinda a bug, so support both
-            if (pos == (FW_HEADER_OFFSET & ~255) 
+            if slot is None and (pos == (FW_HEADER_OFFSET & ~255) 
                 or pos == (total_size - FW_HEADER_SIZE) or pos == total_size):
 
                 prob = check_firmware_hdr(memoryview(here)[-128:], None, bad_magic_ok=True)
@@ -718,17 +924,39 @@ class USBHandler:
             SF.write(pos, here)
 
             # full page write: 0.6 to 3ms
-            while SF.is_busy():
-                await sleep_ms(1)
+            await SF.wait_bg(1)
+
 
+        if end >= total_size:
+            trace.mark('usb:uploaded')
 
-        if offset+len(data) >= total_size and not hsm_active:
+        if end >= total_size and not hsm_active:
             # probably done
             dis.progress_bar_show(1.0)
             ux.restore_menu()
 
         return offset
 
+    def upload_slot(self, offset):
+        # Which PSBT slot is at this flash offset? None if not in dual-slot mode.
+        from glob import hsm_active
+
+        from auth import TXN_SLOT_LEN
+
+        if not (hsm_active and hsm_active.dual_slots):
+            return None
+
+        assert 0 <= offset < MAX_TXN_LEN, 'slot'
+        return offset // TXN_SLOT_LEN
+
+    def check_slot_idle(self, start):
+        # Don't overwrite a PSBT while we are still working on it.
+        from auth import UserAuthorizedAction
+
+        req = UserAuthorizedAction.active_request
+        if req and getattr(req, 'in_offset', None) == start:
+            assert req.result or req.refused or req.failed, 'slot busy'
+
     def handle_xpub(self, subpath):
         # Share the xpub for the indicated subpath. Expects
         # a text string which is the path derivation.
@@ -779,4 +1007,62 @@ class USBHandler:
 
         return b'asci' + val
 
-# EOF 
+# USB command dispatch: cmd => (method, flags, struct format of fixed args)
+# - when format given, the unpacked values are passed after the args
+# - only commands flagged CMD_HSM_OK are allowed once we enter HSM mode
+#   NOTE: 'robo' here would allow firmware changes during HSM mode!
+# - CMD_FAST commands can be answered while a slower request is underway
+_HSM = CMD_HSM_OK
+_MK3 = CMD_MK3
+_FAST = CMD_FAST
+USB_COMMANDS = {
+    # frequent polling/transfer commands
+    'stok': (USBHandler.cmd_stok, _HSM|_FAST, None),      # completion check: sign txn
+    'smok': (USBHandler.cmd_smok, _HSM|_FAST, None),      # completion check: sign msg
+    'bkok': (USBHandler.cmd_stok, _FAST, None),
+    'pwok': (USBHandler.cmd_pwok, _FAST, None),
+    'upld': (USBHandler.cmd_upld, _HSM, '<II'),
+    'dwld': (USBHandler.cmd_dwld, _HSM, '<III'),
+    'sha2': (USBHandler.cmd_sha2, _HSM, None),
+    'hsts': (USBHandler.cmd_hsts, _HSM|_MK3|_FAST, None), # report status values
+    'blkc': (USBHandler.cmd_blkc, _HSM|_FAST, None),
+
+    # harmless/boring
+    'logo': (USBHandler.cmd_logo, _HSM, None),
+    'ping': (USBHandler.cmd_ping, _HSM|_FAST, None),
+    'vers': (USBHandler.cmd_vers, _HSM|_FAST, None),
+    'trce': (USBHandler.cmd_trce, _HSM|_FAST, None),    # timing trace (devmode only)
+
+    # link setup; maybe limited by policy tho
+    'ncry': (USBHandler.cmd_ncry, _HSM, '<I64s'),
+    'mitm': (USBHandler.cmd_mitm, _HSM|CMD_ENCRYPT, None),
+    'tckt': (USBHandler.cmd_tckt, _HSM|CMD_ENCRYPT, None),
+    'rsum': (USBHandler.cmd_rsum, _HSM, '<I32s'),
+
+    # signing and key sharing, limited by HSM policy
+    'stxn': (USBHandler.cmd_stxn, _HSM, '<II32s'),
+    'smsg': (USBHandler.cmd_smsg, _HSM, '<III'),
+    'xpub': (USBHandler.cmd_xpub, _HSM|CMD_ENCRYPT, None),
+    'msck': (USBHandler.cmd_msck, _HSM, '<3I'),
+    'p2sh': (USBHandler.cmd_p2sh, _HSM, '<IBBH'),
+    'show': (USBHandler.cmd_show, _HSM, '<I'),
+
+    # needs local user interaction
+    'enrl': (USBHandler.cmd_enrl, 0, '<I32s'),
+    'pass': (USBHandler.cmd_pass, CMD_ENCRYPT, None),
+    'back': (USBHandler.cmd_back, 0, None),
+
+    # factory and reboots
+    'dfu_': (USBHandler.cmd_dfu_, 0, None),
+    'rebo': (USBHandler.cmd_rebo, 0, None),
+    'bagi': (USBHandler.cmd_bagi, 0, None),
+
+    # HSM and user-related features
+    'hsms': (USBHandler.cmd_hsms, _MK3, None),
+    'gslr': (USBHandler.cmd_gslr, _HSM|_MK3, None),     # read storage locker
+    'nwur': (USBHandler.cmd_nwur, _MK3, '<BBB'),
+    'rmur': (USBHandler.cmd_rmur, _MK3, '<B'),
+    'user': (USBHandler.cmd_user, _HSM|_MK3, '<IBB'),   # other user cmds not allowed
+}
+
+# EOF
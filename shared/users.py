@@ -79,6 +79,9 @@ UserInfo = namedtuple('UserInfo', 'auth_mode secret last_counter')
 class Users:
     '''Track users and thier TOTP secrets or hashed passwords'''    
 
+    # decoded secrets, by username: (base32 value, binary)
+    _secrets = {}
+
     @classmethod
     def get(cls):
         rv = settings.get(KEY)
@@ -95,7 +98,21 @@ class Users:
         t = cls.get()
         assert username in t
         t[username][2] = cnt
-        settings.changed()
+
+        settings.changed(KEY)
+
+    @classmethod
+    def decode_secret(cls, username, secret):
+        # b32 decode, but remember result; no need to repeat for each txn
+        # - cache entry is checked against stored value, so never stale
+        was = cls._secrets.get(username)
+        if was and was[0] == secret:
+            return was[1]
+
+        rv = b32decode(secret)
+        cls._secrets[username] = (secret, rv)
+
+        return rv
 
     @classmethod
     def valid_username(cls, username):
@@ -168,6 +185,7 @@ class Users:
         # remove a user. simple. no checking
         u = cls.get()
         u.pop(username, None)
+        cls._secrets.pop(username, None)
         settings.put(KEY, u)
 
     @classmethod
@@ -197,7 +215,7 @@ class Users:
             return 'unknown user'
 
         auth_mode, secret, last_counter = u
-        secret = b32decode(secret)
+        secret = cls.decode_secret(username, secret)
 
         if auth_mode == USER_AUTH_HMAC:
             expect = hmac_sha256(secret, psbt_hash or bytes(32))
@@ -33,6 +33,21 @@ class imported:
         # recovery that tasty memory.
         gc.collect()
 
+# Bigger modules that are only needed once their menu item is picked. Menus
+# refer to them via lazy() so that booting to the PIN prompt, and drawing the
+# top menu, doesn't load (or grow heap for) code that may never be used.
+LAZY_MODULES = ('address_explorer', 'backups', 'compat7z', 'drv_entro',
+                    'hsm', 'multisig', 'paper', 'users')
+
+def lazy(modname, fname):
+    # Stand-in for modname.fname that imports the module on first call. Works for
+    # menu functions, menu generators and predicates: whatever the real function
+    # returns (incl. a coroutine to await) is passed back.
+    def doit(*a, **kw):
+        return getattr(__import__(modname), fname)(*a, **kw)
+
+    return doit
+
 # class min_dramatic_pause:
 #     # insure that something takes at least N ms
 #     def __init__(self, min_time):
@@ -82,6 +97,19 @@ def pop_count(i):
 
     return (((i + (i >> 4) & 0xF0F0F0F) * 0x1010101) & 0xffffffff) >> 24
 
+# where HSM policy is saved (see hsm.py); here so it can be checked for
+# without loading the HSM code
+HSM_POLICY_FNAME = '/flash/hsm-policy.json'
+
+def hsm_policy_available():
+    # Is there an HSM policy ready to go? Offer the menu item then.
+    import uos
+    try:
+        uos.stat(HSM_POLICY_FNAME)
+        return True
+    except OSError:
+        return False
+
 def get_filesize(fn):
     # like os.path.getsize()
     import uos
@@ -153,7 +181,7 @@ class Base64Writer:
         if self.runt:
             buf = self.runt + buf
         rl = len(buf) % 3
-        self.runt = buf[-rl:] if rl else b''
+        self.runt = bytes(buf[-rl:]) if rl else b''      # buf may be a temp view
         if rl < len(buf):
             tmp = b2a_base64(buf[:(-rl if rl else None)])
             # library puts in newlines!?
@@ -385,6 +413,12 @@ def clean_shutdown(style=0):
     # wipe SPI flash and shutdown (wiping main memory)
     import callgate
     from sflash import SF
+    from nvstore import settings
+
+    try:
+        # changes not yet written (delayed, or in a batch) would be lost
+        settings.flush()
+    except: pass
 
     try:
         SF.wipe_most()
@@ -2,5 +2,7 @@
 #
 from nvstore import settings
 from ujson import dumps
-RV.write(dumps(settings.current))
+
+# saved values, including those kept in their own (namespace) slots
+RV.write(dumps(settings.all_values()))
 
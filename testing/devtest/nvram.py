@@ -25,6 +25,12 @@ a = settings.get('_age', -1)
 settings.save()
 assert settings.get('_age') >= a+1, [settings.get('_age'), a+1]
 
+# age is visible after decrypting first block
+from nvstore import peek_age
+b = bytearray(32)
+SF.read(settings.my_pos, b)
+assert peek_age(settings.get_aes(settings.my_pos).cipher(b)) == settings.get('_age')
+
 chk = dict(settings.current)
 settings.load()
 
@@ -32,6 +38,26 @@ settings.load()
 assert sorted(list(chk)) == sorted(list(settings.current)), \
     'readback fail: \n%r != \n%r' % (chk, settings.current)
 
+# some values live in their own slot
+settings.set('multisig', [['test', 1, 2]])
+settings.save()
+ms_pos = settings.ns_pos['multisig']
+assert ms_pos != settings.my_pos
+settings.load()
+assert 'multisig' not in settings.current
+assert settings.get('multisig') == [['test', 1, 2]]
+assert settings.ns_pos['multisig'] == ms_pos
+
+# .. and are only rewritten when they change
+settings.set('abc', 'changed')
+settings.save()
+assert settings.ns_pos['multisig'] == ms_pos
+settings.remove_key('multisig')
+settings.save()
+assert 'multisig' not in settings.ns_pos
+settings.load()
+assert settings.get('multisig') == None
+
 if 1:
     # fill it up
     covered = set()
@@ -73,6 +99,12 @@ settings.load()
 settings.save()
 assert count_busy() == 4
 
+# erased slots are known, without probing each time
+assert len(settings.blanks) == len(SLOTS) - 4
+assert settings.my_pos not in settings.blanks
+settings.load()
+assert len(settings.blanks) == len(SLOTS) - 4
+
 # check checksum/age stuff works
 settings.set('wrecked', 768)
 settings.save()
@@ -122,3 +154,46 @@ SF.chip_erase()
 settings.load()
 
 
+
+# key derived from SE secret is remembered, until next login
+from pincodes import pa
+if pa.is_successful() and not pa.is_secret_blank():
+    settings.set_key()
+    k = settings.nvram_key
+    assert pa.nvram_key == k
+
+    pa.fetch = lambda *a: 1/0
+    try:
+        settings.set_key()
+    finally:
+        del pa.fetch
+    assert settings.nvram_key == k
+    settings.load()
+
+# batch: several changes and saves, but just one write at the end
+settings.save()
+was_age = settings.get('_age')
+with settings.batch():
+    settings.set('abc', 1)
+    settings.save()
+    settings.set('abc', 2)
+    settings.save()
+    assert settings.get('_age') == was_age
+assert settings.get('_age') == was_age+1
+settings.load()
+assert settings.get('abc') == 2
+
+# while a commit holds the shared buffer, other instances must not touch it
+import nvstore
+nvstore._tmp[0:4] = b'BUSY'
+nvstore._tmp_busy = True
+try:
+    other = nvstore.SettingsObject()
+    other.set('abc', 3)
+    other.save()
+    other.load()
+    assert other.get('abc') == 3
+    settings.load()
+finally:
+    nvstore._tmp_busy = False
+assert nvstore._tmp[0:4] == b'BUSY'
@@ -57,3 +57,11 @@ for raw_txo, expect_type, expect_sw, expect_hash in cases:
     assert addr_type == expect_type, addr_type
 
 
+
+    # round trip: script => address => script, used by HSM whitelists
+    from chains import BitcoinMain, BitcoinTestnet
+    for ch, other in [(BitcoinMain, BitcoinTestnet), (BitcoinTestnet, BitcoinMain)]:
+        addr = ch.render_address(out.scriptPubKey)
+        assert ch.is_payment_script(out.scriptPubKey)
+        assert ch.script_for_address(addr) == out.scriptPubKey, addr
+        assert other.script_for_address(addr) == None, addr
@@ -5,7 +5,7 @@ from nvstore import settings
 from ux import restore_menu
 
 if settings.get('multisig'):
-    del settings.current['multisig']
+    settings.remove_key('multisig')
     settings.save()
 
     print("cleared multisigs")
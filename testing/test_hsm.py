@@ -84,6 +84,9 @@ def hsm_reset(dev, sim_exec):
     (DICT(must_log=1), 'MicroSD card MUST '),
     (DICT(must_log=0), 'MicroSD card will '),
     (DICT(never_log=1), 'No logging'),
+    (DICT(compact_log=1), 'will be compact'),
+    (DICT(rolling_log=1), 'single file: hsm-audit.log'),
+    (DICT(dual_slots=1), 'Two PSBT upload slots'),
     (DICT(warnings_ok=1), 'PSBT warnings'),
     (DICT(priv_over_ux=1), 'optimized for privacy'),
 
@@ -198,7 +201,7 @@ def tweak_rule(sim_exec):
     def doit(idx, new_rule):
         #cmd = f"from hsm import ApprovalRule; from glob import hsm_active; hsm_active.rules[{idx}] = ApprovalRule({dict(new_rule)}, {idx}); hsm_active.summary='**tweaked**'; RV.write(hsm_active.rules[{idx}].to_text())"
         #print(f"Rule #{idx+1} now: {txt}")
-        cmd = f"from hsm import ApprovalRule; from glob import hsm_active; hsm_active.rules[{idx}] = ApprovalRule({dict(new_rule)}, {idx}); hsm_active.summary='**tweaked**'; RV.write('ok')"
+        cmd = f"from hsm import ApprovalRule; from glob import hsm_active; hsm_active.rules[{idx}] = ApprovalRule({dict(new_rule)}, {idx}); hsm_active.index_rules(); hsm_active.summary='**tweaked**'; RV.write('ok')"
         txt = sim_exec(cmd)
         if 'Traceback' in txt:
             raise RuntimeError(txt)
@@ -651,6 +654,94 @@ def test_never_log(dev, start_hsm, attempt_msg_sign, fake_txn, attempt_psbt, sim
     # WEAK test
     attempt_msg_sign(None, b'hello', 'm', addr_fmt=AF_CLASSIC)
 
+def test_compact_log(dev, start_hsm, fake_txn, attempt_psbt, microsd_path):
+    # short log records for transactions, rather than full story
+    policy = DICT(compact_log=True, rules=[{}])
+
+    start_hsm(policy)
+
+    psbt = fake_txn(2, 2, dev.master_xpub)
+
+    fn = microsd_path('psbt/%s.log' % b2a_hex(sha256(psbt).digest()[-8:]).decode('ascii'))
+    try: os.unlink(fn)
+    except FileNotFoundError: pass
+
+    attempt_psbt(psbt)
+
+    log = open(fn, 'rt').read()
+    assert 'Transaction signing requested' in log
+    assert 'APPROVED' in log
+
+    # one line of JSON, in place of the story
+    rec = [ln for ln in log.split('\n') if ln.startswith('{')]
+    assert len(rec) == 1
+    rec = json.loads(rec[0])
+    assert set(rec) == {'total_out', 'dests', 'fee', 'warnings'}
+    assert len(rec['dests']) == 2
+
+    assert '-vvv-' not in log
+    assert 'Network fee' not in log
+    assert ' - to address -' not in log
+
+def test_rolling_log(dev, start_hsm, fake_txn, attempt_psbt, attempt_msg_sign, microsd_path):
+    # all records go into one file on the card
+    policy = DICT(rolling_log=True, msg_paths=['m'], rules=[{}])
+
+    fn = microsd_path('hsm-audit.log')
+    try: os.unlink(fn)
+    except FileNotFoundError: pass
+
+    start_hsm(policy)
+
+    psbt = fake_txn(2, 2, dev.master_xpub)
+    attempt_psbt(psbt)
+    attempt_msg_sign(None, b'hello', 'm', addr_fmt=AF_CLASSIC)
+
+    log = open(fn, 'rt').read()
+    assert 'Transaction signing requested' in log
+    assert 'Message signing requested' in log
+    assert log.count('\n===\n') == 2
+
+def test_dual_slots(dev, start_hsm, fake_txn):
+    # upload next PSBT into other slot, while first is signed
+    from ckcc_protocol.protocol import MAX_TXN_LEN, MAX_BLK_LEN
+    slot_len = MAX_TXN_LEN // 2
+
+    policy = DICT(dual_slots=True, rules=[{}])
+    start_hsm(policy)
+
+    def upload(slot, data):
+        for pos in range(0, len(data), MAX_BLK_LEN):
+            here = data[pos:pos+MAX_BLK_LEN]
+            dev.send_recv(CCProtocolPacker.upload((slot*slot_len)+pos, len(data), here))
+        return sha256(data).digest()
+
+    def download(slot, length):
+        rv = b''
+        while len(rv) < length:
+            rv += dev.send_recv(CCProtocolPacker.download((slot*slot_len)+len(rv),
+                                    min(MAX_BLK_LEN, length-len(rv)), 1))
+        return rv
+
+    psbts = [fake_txn(2, 2, dev.master_xpub), fake_txn(1, 3, dev.master_xpub)]
+
+    # first slot starts at zero: stock helper works, incl. its 'sha2' check
+    ll, sha = dev.upload_file(psbts[0])
+    dev.send_recv(CCProtocolPacker.sign_transaction(len(psbts[0]), sha))
+
+    # next one goes in while first is working
+    sha = upload(1, psbts[1])
+    assert dev.send_recv(CCProtocolPacker.sha256()) == sha
+
+    resp_len, chk = wait_til_signed(dev)
+    dev.send_recv(CCProtocolPacker.sign_transaction(len(psbts[1]), sha, flags=0x80))
+
+    # first result can be read while second is signing
+    assert sha256(download(0, resp_len)).digest() == chk
+
+    resp_len, chk = wait_til_signed(dev)
+    assert sha256(download(1, resp_len)).digest() == chk
+
 @pytest.fixture
 def enter_local_code(need_keypress):
     def doit(code):
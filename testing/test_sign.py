@@ -1007,7 +1007,7 @@ def test_change_troublesome(start_sign, cap_story, try_path, expect):
 
     assert parse_change_back(story) == (Decimal('1.09997082'), ['mvBGHpVtTyjmcfSsy6f715nbTGvwgbgbwo'])
 
-def test_bip143_attack(try_sign, sim_exec, set_xfp, settings_set, settings_get):
+def test_bip143_attack(try_sign, sim_exec, set_xfp, settings_set, settings_get, hist_count):
     # cleanup prev runs
     sim_exec('import history; history.OutptValueCache.clear()')
 
@@ -1024,7 +1024,7 @@ def test_bip143_attack(try_sign, sim_exec, set_xfp, settings_set, settings_get):
 
     assert 'but PSBT claims 15 XTN' in str(ee), ee
 
-    assert len(settings_get('ovc')) == 2
+    assert hist_count() == 2
     sim_exec('import history; history.OutptValueCache.clear()')
 
     # try in opposite order, should also trigger
@@ -1089,7 +1089,7 @@ def spend_outputs(funding_psbt, finalized_txn, tweaker=None):
 def hist_count(sim_exec):
     def doit():
         return int(sim_exec(
-            'import history; RV.write(str(len(history.OutptValueCache.runtime_cache)));'))
+            'import history; RV.write(str(len(history.OutptValueCache.table)));'))
     return doit
 
 @pytest.mark.parametrize('num_utxo', [9, 100])
@@ -1116,7 +1116,7 @@ def test_bip143_attack_data_capture(num_utxo, segwit_in, try_sign, fake_txn, set
     assert 'TXID' in title, story
     txid = story.strip()
 
-    assert hist_count() in {128, hist_b4+num_utxo+num_inp_utxo}
+    assert hist_count() == hist_b4+num_utxo+num_inp_utxo
 
     # compare to PyCoin
     from pycoin.tx.Tx import Tx
@@ -1125,11 +1125,8 @@ def test_bip143_attack_data_capture(num_utxo, segwit_in, try_sign, fake_txn, set
 
     # expect all of new "change outputs" to be recorded (none of the non-segwit change tho)
     # plus the one input we "revealed"
-    after1 = settings_get('ovc')
-    assert len(after1) == min(30, num_utxo + num_inp_utxo)
-
-    all_utxo = hist_count()
-    assert all_utxo == hist_b4+num_utxo+num_inp_utxo
+    after1 = hist_count()
+    assert after1 == hist_b4+num_utxo+num_inp_utxo
 
     # build a new PSBT based on those change outputs
     psbt2, raw = spend_outputs(psbt, txn)
@@ -1139,7 +1136,7 @@ def test_bip143_attack_data_capture(num_utxo, segwit_in, try_sign, fake_txn, set
     time.sleep(.1)
 
     # should not affect stored data, because those values already cached
-    assert settings_get('ovc') == after1
+    assert hist_count() == after1
 
     # any tweaks to input side's values should fail.
     for amt in [int(1E6), 1]:
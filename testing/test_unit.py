@@ -240,4 +240,21 @@ def test_match_deriv_path(patterns, paths, answers, sim_exec):
         assert rv == str(bool(ans))
     
 
+def test_boot_profile(sim_eval, max_modules=70):
+    # time and heap used getting to the PIN prompt; heavy modules must stay deferred
+    prof = eval(sim_eval('glob.boot_profile'))
+    labels = [p[0] for p in prof]
+    assert labels == ['display', 'settings', 'login', 'menu']
+
+    t0 = prof[0][1]
+    for label, when, mods, early, heap in prof:
+        print('%-10s %6d ms  %3d modules  %7d heap' % (label, when-t0, mods, heap))
+
+    _, _, mods, early, _ = prof[labels.index('login')]
+    assert early == 0, 'deferred module imported before PIN prompt'
+    assert mods <= max_modules
+
+    assert prof[-1][3] == 0, 'deferred module imported for top menu'
+    
+
 # EOF
@@ -64,6 +64,16 @@ def test_usb_fuzz(dev):
         break
     
 
+def test_usb_bad_command(dev):
+    # command name that isn't text: framing error reply, not a general error
+    dev.dev.write(bytes([4 | 0x80]) + b'\xff\xfe\xfd\xfc' + bytes(64-4-1))
+    resp = bytes(dev.dev.read(64, timeout_ms=500))
+    msg = resp[1:1+(resp[0] & 0x3f)]
+    assert msg == b'framdecode', repr(resp)
+
+    # and still working after that
+    assert dev.send_recv(CCProtocolPacker.ping(b'hello')) == b'hello'
+
 # note: 0x80000000 = 2147483648
 
 @pytest.mark.parametrize('path', [ '', 'm', 'm/1', "m/1'", "m/1'/0/1'",
@@ -196,6 +206,46 @@ def test_mitm(dev):
 
     assert dev.mitm_verify(sig2, dev.master_xpub) == False
 
+def test_session_resume(dev):
+    # get a ticket, then resume session with it, rather than full ECDH
+    import os, hmac, hashlib
+
+    tkt = dev.send_recv(b'tckt', encrypt=1)
+    assert len(tkt) == 72
+
+    # must be encrypted
+    with pytest.raises(CCProtoError) as ee:
+        dev.send_recv(b'tckt', encrypt=0)
+    assert 'must encrypt' in str(ee)
+
+    old_key = dev.session_key
+    my_nonce = os.urandom(32)
+    rv = dev.send_recv(b'rsum' + struct.pack('<I', 1) + my_nonce + tkt, encrypt=0)
+    his_nonce, tkt2 = rv[0:32], rv[32:]
+    assert len(tkt2) == 72
+
+    new_key = hmac.new(old_key, b'resume'+my_nonce+his_nonce, hashlib.sha256).digest()
+    dev.aes_setup(new_key)
+    dev.session_key = new_key
+
+    rb = dev.send_recv(CCProtocolPacker.ping(b'hello'), encrypt=1)
+    assert rb == b'hello'
+
+    # old ticket is no longer valid
+    with pytest.raises(CCProtoError) as ee:
+        dev.send_recv(b'rsum' + struct.pack('<I', 1) + my_nonce + tkt, encrypt=0)
+    assert 'stale ticket' in str(ee)
+
+    # corrupted ticket
+    bad = bytearray(tkt2)
+    bad[20] ^= 0x1
+    with pytest.raises(CCProtoError) as ee:
+        dev.send_recv(b'rsum' + struct.pack('<I', 1) + my_nonce + bytes(bad), encrypt=0)
+    assert 'bad ticket' in str(ee)
+
+    # cleanup
+    dev.start_encryption()
+
 def test_remote_upload(dev):
     import os
     dev.upload_file(b'testing')
@@ -211,4 +261,23 @@ def test_remote_up_download(f_len, dev):
     rb = dev.download_file(ll, sha, file_number=0)
     assert rb == data
 
+def test_timing_trace(dev, is_simulator):
+    # debug-only timing trace: see shared/trace.py
+    if not is_simulator():
+        raise pytest.skip('needs devmode')
+
+    dev.send_recv(b'trcec')         # read and clear
+
+    data = b'a'*300
+    v = dev.send_recv(CCProtocolPacker.upload(0, len(data), data))
+    assert v == 0
+
+    rv = dev.send_recv(b'trce')
+    hdr, *lines = rv.split('\n')
+    assert hdr == '# %d events, 0 dropped' % len(lines)
+
+    usb = [ln.split() for ln in lines if ln.endswith(('usb:upload', 'usb:uploaded'))]
+    assert [u[-1] for u in usb] == ['usb:upload', 'usb:uploaded']
+    assert int(usb[1][0]) >= int(usb[0][0])
+
 # EOF
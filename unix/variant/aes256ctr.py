@@ -1,6 +1,21 @@
 # slow replacement for ARM assembly code module
 import ngu
 
-def new(key, nonce=None):
-    return ngu.aes.CTR(key, nonce or bytes(16))
+class new:
+    def __init__(self, key, nonce=None, _ctr=None):
+        self.ctr = _ctr or ngu.aes.CTR(key, nonce or bytes(16))
 
+    def cipher(self, buf, out=None):
+        rv = self.ctr.cipher(buf)
+        if out is None:
+            return rv
+
+        # mimic in-place operation of real thing
+        out[0:len(rv)] = rv
+        return out
+
+    def copy(self):
+        return new(None, _ctr=self.ctr.copy())
+
+    def blank(self):
+        self.ctr.blank()
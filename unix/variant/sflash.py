@@ -11,6 +11,12 @@ class SPIFlash:
 
     array = bytearray(_SIZE)
 
+    # erases are instant here, so never really busy in background
+    bg_busy = 0
+
+    async def wait_bg(self, poll_ms=2):
+        return
+
     def read(self, address, buf, **kw):
         # random read
         buf[0:len(buf)] = self.array[address:address+len(buf)]
@@ -49,9 +55,9 @@ class SPIFlash:
 
     def wipe_most(self):
         # XXX ux here is bad
-        # erase everything except settings: takes 5 seconds at least
-        from nvstore import SLOTS
-        end = SLOTS[0]
+        # erase everything except settings and history: takes 5 seconds at least
+        from nvstore import HISTORY_RING
+        end = HISTORY_RING.start
 
         from main import dis
         dis.fullscreen("Cleanup...")